@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- load test of the forum through its WSGI interface
+#
+# For every table size the posts table of a scratch database is created from
+# forum.sql and seeded, then View and Post are called through the Dispatcher
+# by a number of threads at the same time, without a web server in between:
+#
+#   python benchmark.py --dsn "dbname=forum_bench" --sizes 1000 1000000
+#
+# Results are written as JSON so runs of different versions can be diffed.
+#
+
+import argparse
+import json
+import os
+import platform
+import random
+import StringIO
+import threading
+import time
+import urllib
+from wsgiref import util
+
+import psycopg2
+import psycopg2.extensions
+
+import forum
+import forumdb
+import pagecache
+
+## Database round trips since the last call to RoundTrips()
+ROUNDTRIPS = [0]
+ROUNDTRIPS_LOCK = threading.Lock()
+
+## Keys of older pages requested by the benchmark
+SAMPLE_KEYS = 100
+
+
+def Count():
+    '''Count one database round trip.'''
+    with ROUNDTRIPS_LOCK:
+        ROUNDTRIPS[0] += 1
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    '''Cursor that counts the statements it sends to the database.
+
+    A fetch from a named cursor is a round trip of its own and counted too.
+    '''
+
+    def execute(self, query, vars=None):
+        Count()
+        return psycopg2.extensions.cursor.execute(self, query, vars)
+
+    def fetchmany(self, size=None):
+        if self.name:
+            Count()
+        if size is None:
+            size = self.arraysize
+        return psycopg2.extensions.cursor.fetchmany(self, size)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    '''Connection that hands out counting cursors and counts commits.'''
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return psycopg2.extensions.connection.cursor(self, *args, **kwargs)
+
+    def commit(self):
+        Count()
+        return psycopg2.extensions.connection.commit(self)
+
+    def rollback(self):
+        Count()
+        return psycopg2.extensions.connection.rollback(self)
+
+
+class NoCache(pagecache.PageCache):
+    '''Page cache that never has a page, to measure rendering every page.'''
+
+    def Get(self, key):
+        return None
+
+
+def RoundTrips():
+    '''Return the round trips counted since the last call and reset them.'''
+    with ROUNDTRIPS_LOCK:
+        count = ROUNDTRIPS[0]
+        ROUNDTRIPS[0] = 0
+    return count
+
+
+def Seed(dsn, size):
+    '''Create the posts table from forum.sql and fill it with size posts.
+
+    The posts are one second apart and rendered like forumdb renders them.
+
+    Returns:
+      Keys of SAMPLE_KEYS random posts, to request older pages with.
+    '''
+    schema = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'forum.sql')).read()
+    # the template split around its fields, to render the posts in SQL
+    before, rest = forumdb.POST.split('%(time)s')
+    between, after = rest.split('%(content)s')
+    pg = psycopg2.connect(dsn)
+    c = pg.cursor()
+    c.execute("drop table if exists posts")
+    c.execute(schema)
+    c.execute("insert into posts (content, time, html)"
+              " select content, time, %s || time || %s || content || %s"
+              " from (select 'Post number ' || n as content,"
+              "        localtimestamp - n * interval '1 second' as time"
+              "       from generate_series(1, %s) as n) as p",
+              (before, between, after, size))
+    c.execute("select time, id from posts where id = any(%s)",
+              (random.sample(xrange(1, size + 1), min(SAMPLE_KEYS, size)), ))
+    keys = c.fetchall()
+    pg.commit()
+    pg.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    c.execute("vacuum analyze posts")
+    pg.close()
+    return keys
+
+
+def Request(app, method, query='', body=''):
+    '''Call app like a web server would and read the whole response.
+
+    Returns:
+      The status line of the response.
+    '''
+    env = {'REQUEST_METHOD': method,
+           'PATH_INFO': '/post' if method == 'POST' else '/',
+           'QUERY_STRING': query,
+           'CONTENT_LENGTH': str(len(body)),
+           'wsgi.input': StringIO.StringIO(body)}
+    util.setup_testing_defaults(env)
+    status = []
+    def start_response(line, headers):
+        status.append(line)
+    result = app(env, start_response)
+    try:
+        for chunk in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status[0]
+
+
+def Percentile(latencies, p):
+    '''Return the p-th percentile of sorted latencies.'''
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def Drive(app, keys, requests, concurrency, writes, older, seed):
+    '''Send requests requests from concurrency threads at the same time.
+
+    Args:
+      writes: Chance of a request being a Post.
+      older: Chance of a View being of an older page instead of the first.
+
+    Returns:
+      A dict with the latencies in seconds, requests per second and round
+      trips per request.
+    '''
+    latencies = []
+    errors = []
+    left = [requests]
+    lock = threading.Lock()
+
+    def Client(n):
+        rng = random.Random(seed * 1000 + n)
+        while True:
+            with lock:
+                if left[0] == 0:
+                    return
+                left[0] -= 1
+            if rng.random() < writes:
+                args = ('POST', '', urllib.urlencode(
+                    [('content', 'Benchmark post %d' % rng.randint(0, 10**9))]))
+            elif keys and rng.random() < older:
+                args = ('GET', urllib.urlencode(
+                    [('before', forumdb.FormatKey(rng.choice(keys)))]))
+            else:
+                args = ('GET', )
+            start = time.time()
+            status = Request(app, *args)
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                if status[0] not in '23':
+                    errors.append(status)
+
+    RoundTrips()
+    start = time.time()
+    clients = [threading.Thread(target=Client, args=(n, ))
+               for n in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.time() - start
+    latencies.sort()
+    return {'concurrency': concurrency,
+            'requests': requests,
+            'errors': len(errors),
+            'seconds': seconds,
+            'rps': requests / seconds,
+            'p50': Percentile(latencies, 50),
+            'p95': Percentile(latencies, 95),
+            'p99': Percentile(latencies, 99),
+            'roundtrips_per_request': RoundTrips() / float(requests)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the forum through its WSGI interface.')
+    parser.add_argument('--dsn', default='dbname=forum_bench',
+                        help='scratch database, its posts table is replaced')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='number of posts to seed the table with')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8],
+                        help='numbers of clients sending requests at once')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per size and concurrency')
+    parser.add_argument('--writes', type=float, default=0.05,
+                        help='chance of a request adding a post')
+    parser.add_argument('--older', type=float, default=0.2,
+                        help='chance of a view being of an older page')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='render every page instead of caching them')
+    parser.add_argument('--async-writes', action='store_true',
+                        help='write posts in batches in the background')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json',
+                        help='file the JSON results are written to')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = {'python': platform.python_version(),
+              'dsn': args.dsn,
+              'cache': not args.no_cache,
+              'async_writes': args.async_writes,
+              'writes': args.writes,
+              'older': args.older,
+              'seed': args.seed,
+              'runs': []}
+    for size in args.sizes:
+        print "%d posts" % size
+        keys = Seed(args.dsn, size)
+        for concurrency in args.concurrency:
+            # every run starts without cached pages
+            app = forum.make_app(NoCache() if args.no_cache
+                                 else pagecache.PageCache())
+            forumdb.InitPool(args.dsn, maxconn=concurrency + 1,
+                             connection_factory=CountingConnection)
+            if args.async_writes:
+                forumdb.EnableAsyncWrites(on_commit=forum.CACHE.Invalidate)
+            result = Drive(app, keys, args.requests, concurrency, args.writes,
+                         args.older, args.seed)
+            forumdb.DisableAsyncWrites()
+            forumdb.ClosePool()
+            result['posts'] = size
+            report['runs'].append(result)
+            print ("  %d clients: %.0f requests/s, p50 %.1fms, p95 %.1fms,"
+                   " p99 %.1fms, %.2f round trips per request") % (
+                concurrency, result['rps'], result['p50'] * 1000,
+                result['p95'] * 1000, result['p99'] * 1000,
+                result['roundtrips_per_request'])
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print "Results written to %s" % args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,22 @@
 
 # The forumdb module is where the database interface code goes.
 import forumdb
+import pagecache
 
 # Other modules used to run a web server.
+import argparse
 import cgi
-from wsgiref.simple_server import make_server
+import Queue
+import signal
+import threading
+import urllib
+from wsgiref.simple_server import make_server, WSGIServer
 from wsgiref import util
 
+# Cache of rendered pages, a pagecache.RedisPageCache() shares the pages
+# between server processes.
+CACHE = pagecache.PageCache()
+
 # HTML template for the forum page
 HTML_WRAP = '''\
 <!DOCTYPE html>
@@ -32,29 +42,126 @@ HTML_WRAP = '''\
       <div><textarea id="content" name="content"></textarea></div>
       <div><button id="go" type="submit">Post message</button></div>
     </form>
+    <form method=get action="/search">
+      <div><input name="q"> <button type="submit">Search</button></div>
+    </form>
     <!-- post content will go here -->
 %s
   </body>
 </html>
 '''
 
-# HTML template for an individual comment
-POST = '''\
-    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+# The forum page before and after the posts, for streaming it
+HEADER, FOOTER = (HTML_WRAP % '\0').split('\0')
+
+# Rendered pages larger than this are not cached
+CACHE_LIMIT = 256 * 1024
+
+# HTML template for the link to the next page of older posts
+OLDER = '''\
+    <div class=older><a href="/?%(query)s">Older posts</a></div>
 '''
 
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and a page of the previously posted
+    messages. ?before=<time,id> shows the page of posts older than the post
+    with that key, ?limit= the number of posts on a page.
+
+    The page is sent while the posts are read from the database, rendered
+    pages up to CACHE_LIMIT bytes are cached. New posts only show up on the
+    first page, so the first page is cached per generation of the cache and
+    older pages never change. The ETag of a page tells a browser it has the
+    page already.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    before = None
+    if 'before' in fields:
+        before = forumdb.ParseKey(fields['before'][0])
+    limit = forumdb.PAGE_SIZE
+    if fields.get('limit', [''])[0].isdigit():
+        limit = max(1, min(int(fields['limit'][0]), forumdb.MAX_PAGE_SIZE))
+    if before is None:
+        key = 'first:%d:%d' % (CACHE.Generation(), limit)
+    else:
+        key = 'before:%s:%d' % (forumdb.FormatKey(before), limit)
+    etag = '"%s"' % key
+    headers = [('Content-type', 'text/html'),
+               ('ETag', etag),
+               ('Cache-Control', 'no-cache')]
+    if env.get('HTTP_IF_NONE_MATCH') == etag:
+        resp('304 Not Modified', headers[1:])
+        return []
+    html = CACHE.Get(key)
     # send results
+    resp('200 OK', headers)
+    if html is not None:
+        return [html]
+    return Render(key, before, limit)
+
+def Render(key, before, limit):
+    '''Yield the forum page in chunks as the posts come from the database.
+
+    The page is cached under key once it is complete, unless it is larger than
+    CACHE_LIMIT.
+    '''
+    chunks = [HEADER]
+    size = len(HEADER)
+    yield HEADER
+    last = None
+    for n, (chunk, postKey) in enumerate(forumdb.IterPosts(before, limit)):
+        if n == limit:
+            # there is an older post, link to the page after the last one
+            query = urllib.urlencode([('before', forumdb.FormatKey(last)),
+                                      ('limit', limit)])
+            chunk = OLDER % {'query': cgi.escape(query, True)}
+        last = postKey
+        if chunks is not None:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > CACHE_LIMIT:
+                chunks = None
+        yield chunk
+    if chunks is not None:
+        chunks.append(FOOTER)
+        CACHE.Put(key, ''.join(chunks))
+    yield FOOTER
+
+# HTML templates for search results
+RESULTS = '''\
+    <h2>Posts with &ldquo;%(q)s&rdquo;</h2>
+'''
+NO_RESULTS = '''\
+    <div class=post>No posts found.</div>
+'''
+MORE_RESULTS = '''\
+    <div class=older><a href="/search?%(query)s">More results</a></div>
+'''
+
+## Request handler for searching posts
+def Search(env, resp):
+    '''Search shows the posts containing the words of ?q=, best match first.
+
+    ?page= is the number of the page of results, starting at 0.
+    '''
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    q = fields.get('q', [''])[0].strip()
+    page = 0
+    if fields.get('page', [''])[0].isdigit():
+        page = int(fields['page'][0])
+    posts, more = [], False
+    if q:
+        posts, more = forumdb.SearchPosts(q, page)
+    html = RESULTS % {'q': cgi.escape(q)}
+    html += ''.join(p['html'] for p in posts) or NO_RESULTS
+    if more:
+        query = urllib.urlencode([('q', q), ('page', page + 1)])
+        html += MORE_RESULTS % {'query': cgi.escape(query, True)}
     headers = [('Content-type', 'text/html')]
     resp('200 OK', headers)
-    return [HTML_WRAP % ''.join(POST % p for p in posts)]
+    return [HTML_WRAP % html]
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
@@ -74,8 +181,11 @@ def Post(env, resp):
         # If the post is just whitespace, don't save it.
         content = content.strip()
         if content:
-            # Save it in the database
+            # Save it in the database, the first page shows it from now on.
+            # Batched writes start a new generation when they are written.
             forumdb.AddPost(content)
+            if forumdb.WRITER is None:
+                CACHE.Invalidate()
     # 302 redirect back to the main page
     headers = [('Location', '/'),
                ('Content-type', 'text/plain')]
@@ -85,6 +195,7 @@ def Post(env, resp):
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -100,8 +211,120 @@ def Dispatcher(env, resp):
         return ['Not Found: ' + page]
 
 
-# Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
+## Build the WSGI application
+def make_app(cache=None):
+    '''Return the forum as a WSGI application, without starting a server.
+
+    Args:
+      cache: The page cache to use, see CACHE.
+    '''
+    global CACHE
+    if cache is not None:
+        CACHE = cache
+    return Dispatcher
+
+
+## Server handling requests in a pool of threads
+class ThreadPoolMixIn:
+    '''Mix-in for a SocketServer server that handles every request in one of
+    a fixed number of worker threads.
+
+    Accepted requests wait in a queue as long as the number of workers, while
+    it is full no more requests are accepted.
+    '''
+
+    def start_workers(self, workers):
+        '''Start the worker threads, before serving.'''
+        self.requests = Queue.Queue(workers)
+        self.workers = [threading.Thread(target=self.work)
+                        for n in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def stop_workers(self):
+        '''Let the workers finish the waiting requests and wait for them.'''
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    '''WSGI server handling requests in a pool of worker threads.'''
+
+
+## Serve the forum
+def serve(host='', port=8000, workers=8, app=None, async_writes=False):
+    '''Serve the forum until interrupted or terminated.
+
+    On Ctrl-C or SIGTERM no new requests are accepted, the requests that were
+    accepted are finished, queued posts are written and the database
+    connections are closed.
+
+    Args:
+      host: The address to listen on, '' for all addresses.
+      port: The port to listen on.
+      workers: The number of requests handled at the same time, the database
+        connection pool is sized to match.
+      app: The WSGI application, default make_app().
+      async_writes: True writes new posts in batches in the background, see
+        forumdb.EnableAsyncWrites().
+    '''
+    # one more connection for the background writer
+    forumdb.InitPool(maxconn=workers + 1)
+    if async_writes:
+        forumdb.EnableAsyncWrites(on_commit=CACHE.Invalidate)
+    httpd = make_server(host, port, app or make_app(),
+                        server_class=ThreadPoolWSGIServer)
+    httpd.start_workers(workers)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    print "Serving HTTP on port %d with %d workers..." % (port, workers)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print "Shutting down..."
+    finally:
+        httpd.server_close()
+        httpd.stop_workers()
+        forumdb.DisableAsyncWrites()
+        forumdb.ClosePool()
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the DB Forum.')
+    # Run this bad server only on localhost!
+    parser.add_argument('--host', default='',
+                        help='address to listen on, default all addresses')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='requests handled at the same time')
+    parser.add_argument('--redis', action='store_true',
+                        help='cache pages in the local Redis server')
+    parser.add_argument('--async-writes', action='store_true',
+                        help='write new posts in batches in the background')
+    args = parser.parse_args()
+    cache = None
+    if args.redis:
+        cache = pagecache.RedisPageCache()
+    serve(args.host, args.port, args.workers, make_app(cache),
+          args.async_writes)
@@ -1,5 +1,21 @@
+-- The posts of the forum. A database created with an older version of this
+-- file is brought up to date by upgrade.sql.
 
+-- html is the post rendered for the forum page when it was added, posts
+-- without it are rendered when they are read.
+-- search holds the words of the post for full-text search, it is kept up to
+-- date by the posts_search trigger.
 CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     id SERIAL );
+                     id SERIAL PRIMARY KEY,
+                     html TEXT,
+                     search TSVECTOR );
 
+-- Pages of posts are read newest first, the id breaks ties in time.
+CREATE INDEX posts_time_id ON posts (time DESC, id DESC);
+
+-- Full-text search, the configuration must match the one of SearchPosts().
+CREATE INDEX posts_search ON posts USING GIN (search);
+CREATE TRIGGER posts_search BEFORE INSERT OR UPDATE ON posts
+  FOR EACH ROW EXECUTE PROCEDURE
+  tsvector_update_trigger(search, 'pg_catalog.english', content);
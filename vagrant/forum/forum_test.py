@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Test cases for the forum that run without a database or a web server: the
+# page cache, the keys of pages and the background writer of posts.
+#
+
+import datetime
+import StringIO
+import sys
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import forum
+import forumdb
+import pagecache
+
+def testPageCache():
+    '''
+    Test that the page cache keeps the most recently used pages and that a
+    new generation starts at every post.
+    '''
+    cache = pagecache.PageCache(size=2)
+    cache.Put('a', 'page a')
+    cache.Put('b', 'page b')
+    if cache.Get('a') != 'page a':
+        raise ValueError("A cached page should be returned.")
+    cache.Put('c', 'page c')
+    if cache.Get('b') is not None:
+        raise ValueError("The least recently used page should go first.")
+    if cache.Get('a') != 'page a' or cache.Get('c') != 'page c':
+        raise ValueError("The most recently used pages should be kept.")
+    generation = cache.Generation()
+    cache.Invalidate()
+    if cache.Generation() != generation + 1:
+        raise ValueError("Invalidate() should start a new generation.")
+    if pagecache.PageCache().Generation() == pagecache.PageCache().Generation():
+        raise ValueError("Caches should start at a random generation.")
+    print "1. The page cache keeps recent pages and counts generations."
+
+def testKeys():
+    '''
+    Test that the key of a post survives the before parameter of a page.
+    '''
+    for key in [(datetime.datetime(2016, 2, 29, 13, 45, 7, 123456), 42),
+                (datetime.datetime(2016, 2, 29, 13, 45, 7), 43),
+                (datetime.datetime(2016, 2, 29, 13, 45, 7, 1), 44)]:
+        if forumdb.ParseKey(forumdb.FormatKey(key)) != key:
+            raise ValueError("ParseKey should return the key FormatKey was given, "
+                             "got {} for {}".format(
+                                 forumdb.ParseKey(forumdb.FormatKey(key)), key))
+    for text in ['', 'yesterday,1', '2016-02-29T13:45:07', '2016-02-29T13:45:07,x']:
+        if forumdb.ParseKey(text) is not None:
+            raise ValueError("ParseKey should return None for %r." % text)
+    print "2. Keys of posts are formatted and parsed back."
+
+def testPageHeaders():
+    '''
+    Test that a page the browser has is not sent again and that cached pages
+    are sent without reading the posts.
+    '''
+    key = forumdb.FormatKey((datetime.datetime(2016, 2, 29, 13, 45, 7), 42))
+    responses = []
+    def resp(status, headers):
+        responses.append((status, dict(headers)))
+    env = {'QUERY_STRING': 'before=%s&limit=5' % key,
+           'HTTP_IF_NONE_MATCH': '"before:%s:5"' % key}
+    if forum.View(env, resp) != [] or responses[-1][0] != '304 Not Modified':
+        raise ValueError("A page the browser has should not be sent again.")
+    forum.CACHE.Put('first:%d:%d' % (forum.CACHE.Generation(), forumdb.PAGE_SIZE),
+                    'cached page')
+    page = forum.View({'QUERY_STRING': ''}, resp)
+    if page != ['cached page'] or responses[-1][0] != '200 OK':
+        raise ValueError("A cached page should be sent as it is.")
+    etag = responses[-1][1]['ETag']
+    forum.CACHE.Invalidate()
+    forum.View({'QUERY_STRING': '', 'HTTP_IF_NONE_MATCH': etag},
+               lambda status, headers: responses.append((status, dict(headers))))
+    if responses[-1][1]['ETag'] == etag:
+        raise ValueError("A new post should change the ETag of the first page.")
+    print "3. Pages are sent with an ETag and are not sent twice."
+
+class Writes(object):
+    '''Stands in for forumdb.WritePosts, failing with the given errors first.'''
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.batches = []
+
+    def __call__(self, posts):
+        if self.errors:
+            raise self.errors.pop(0)
+        if [post for post in posts if post.startswith('bad')]:
+            raise psycopg2.DataError("refused")
+        self.batches.append(list(posts))
+
+def withWrites(writes, test):
+    '''Run test with writes in place of forumdb.WritePosts, returns what was
+    written to stderr.'''
+    saved = forumdb.WritePosts, forumdb.RETRY_INTERVAL, sys.stderr
+    forumdb.WritePosts = writes
+    forumdb.RETRY_INTERVAL = 0.01
+    sys.stderr = StringIO.StringIO()
+    try:
+        test()
+        return sys.stderr.getvalue()
+    finally:
+        forumdb.WritePosts, forumdb.RETRY_INTERVAL, sys.stderr = saved
+
+def testPostWriter():
+    '''
+    Test that the background writer writes every post before it closes, drops
+    only the posts the database refuses and gives up on a database that can
+    not be reached.
+    '''
+    posts = ['post %d' % n for n in range(25)]
+    writes = Writes(psycopg2.InterfaceError("connection already closed"))
+    def drain():
+        writer = forumdb.PostWriter(batch=10, interval=1, size=5)
+        for post in posts:
+            writer.Add(post)
+        writer.Close()
+        if writer.Add('late post'):
+            raise ValueError("A closed writer should not take posts.")
+    withWrites(writes, drain)
+    if sum(writes.batches, []) != posts:
+        raise ValueError("Close() should write every post in order, got {}".format(
+            writes.batches))
+    if max(len(batch) for batch in writes.batches) > 10:
+        raise ValueError("A batch should have at most batch posts.")
+
+    writes = Writes()
+    def refused():
+        writer = forumdb.PostWriter(batch=10, interval=1)
+        for post in ['good 1', 'bad 2', 'good 3']:
+            writer.Add(post)
+        writer.Close()
+    log = withWrites(writes, refused)
+    if sum(writes.batches, []) != ['good 1', 'good 3']:
+        raise ValueError("A refused batch should be written one post at a time.")
+    if "Dropped post: 'bad 2'" not in log:
+        raise ValueError("A refused post should be logged.")
+
+    writes = Writes(psycopg2.extensions.QueryCanceledError("canceling statement"))
+    def single():
+        writer = forumdb.PostWriter(batch=10, interval=1)
+        writer.Add('good 1')
+        writer.Close()
+    log = withWrites(writes, single)
+    if writes.batches or "Dropped post: 'good 1'" not in log:
+        raise ValueError("A cancelled statement should not be tried again.")
+
+    writes = Writes(*[psycopg2.OperationalError("could not connect")] * 1000)
+    def down():
+        writer = forumdb.PostWriter(batch=2, interval=0.01, size=3)
+        for post in posts[:5]:
+            writer.Add(post)
+        start = time.time()
+        writer.Close(timeout=0.2)
+        if time.time() - start > 1:
+            raise ValueError("Close() should give up after its timeout.")
+    log = withWrites(writes, down)
+    if writes.batches or [post for post in posts[:5]
+                          if "Post not written: %r" % post not in log]:
+        raise ValueError("The posts that were not written should be logged.")
+    print "4. The background writer writes, drops and gives up on posts."
+
+
+if __name__ == '__main__':
+    testPageCache()
+    testKeys()
+    testPageHeaders()
+    testPostWriter()
+    print "Success!  All tests pass!"
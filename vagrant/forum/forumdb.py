@@ -2,44 +2,588 @@
 # Database access functions for the web forum.
 #
 
+import atexit
+import datetime
+import Queue
+import sys
+import threading
 import time
+import traceback
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import bleach
 
-## Database connection
-DB = []
+## HTML template for an individual post, rendered when it is added
+POST = '''\
+    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+'''
 
-## Get posts from database.
-def GetAllPosts():
-    '''Get all the posts from the database, sorted with the newest first.
+## Connection pool settings, see InitPool()
+DSN = "dbname=forum"
+POOL_MIN = 1
+POOL_MAX = 10
+POOL_KWARGS = {}
+
+## Posts per page by default and at most, see IterPosts()
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+## Text search configuration of the posts_search trigger in forum.sql
+SEARCH_CONFIG = 'english'
+
+## Deepest page of search results, see SearchPosts()
+MAX_SEARCH_PAGE = 50
+
+## Rows read per round trip by IterPosts()
+ITERSIZE = 50
+
+## Batched writes of posts, see EnableAsyncWrites()
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.05
+QUEUE_SIZE = 1000
+
+## Seconds to wait before trying a failed batch again
+RETRY_INTERVAL = 1
+
+## Seconds Close() of a PostWriter waits for the queued posts to be written
+CLOSE_TIMEOUT = 10
+
+## The PostWriter of AddPost(), None writes every post at once
+WRITER = None
+
+## Seconds a pooled connection may sit idle before it is checked on reuse
+IDLE_CHECK = 30
+
+## Database connection pool, created by InitPool() or on first use
+POOL = None
+
+## Free connections of the pool, callers wait here when all are in use
+SLOTS = None
+
+## Time each pooled connection was last handed back
+IDLE_SINCE = {}
+
+## Connections taken from the pool or waited for, the pool is not replaced or
+## closed while there are any
+CHECKED_OUT = 0
+
+## Guards creating and replacing the pool
+POOL_LOCK = threading.Lock()
+
+## Create the connection pool.
+def InitPool(dsn=None, minconn=None, maxconn=None, **kwargs):
+    '''Create the connection pool, closing the one that is open.
+
+    Call it once at startup with maxconn at least the number of threads that
+    serve requests, or leave it to the first database call to create a pool
+    with the default settings.
+
+    Args:
+      dsn: The database to connect to, default DSN.
+      minconn: Connections opened at once and kept open, default POOL_MIN.
+      maxconn: Most connections open at the same time, default POOL_MAX.
+      kwargs: Passed on to psycopg2.connect() for every connection, e.g.
+        connection_factory. Replace the ones given before when not empty.
+
+    Raises:
+      psycopg2.pool.PoolError: Connections of the open pool are in use.
+    '''
+    global DSN, POOL_MIN, POOL_MAX, POOL_KWARGS
+    with POOL_LOCK:
+        CheckIdle()
+        if dsn is not None:
+            DSN = dsn
+        if minconn is not None:
+            POOL_MIN = minconn
+        if maxconn is not None:
+            POOL_MAX = maxconn
+        if kwargs:
+            POOL_KWARGS = kwargs
+        OpenPool()
+
+def OpenPool():
+    '''Replace the pool by a new one, called with POOL_LOCK held.'''
+    global POOL, SLOTS
+    if POOL is not None:
+        POOL.closeall()
+    IDLE_SINCE.clear()
+    POOL = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, DSN,
+                                                **POOL_KWARGS)
+    SLOTS = threading.BoundedSemaphore(POOL_MAX)
+
+def CheckIdle():
+    '''Raise PoolError if connections are in use, called with POOL_LOCK held.
+
+    Connections in use are handed back to the pool and semaphore they came
+    from, those can not be replaced before.
+    '''
+    if CHECKED_OUT:
+        raise psycopg2.pool.PoolError(
+            "%d connections of the pool are in use" % CHECKED_OUT)
+
+## Close the connection pool.
+def ClosePool():
+    '''Close all connections of the pool, the next call opens a new pool.
+
+    Raises:
+      psycopg2.pool.PoolError: Connections of the pool are in use.
+    '''
+    global POOL
+    with POOL_LOCK:
+        CheckIdle()
+        if POOL is not None:
+            POOL.closeall()
+            POOL = None
+        IDLE_SINCE.clear()
+
+## Take a connection from the pool.
+def GetConnection():
+    '''Take a working connection from the pool, waiting while all are in use.
+
+    A connection that sat idle in the pool for more than IDLE_CHECK seconds
+    is checked with a query first and replaced if the database dropped it.
+    Connections in steady use are not checked.
+
+    Returns:
+      A connection, hand it back with PutConnection().
+    '''
+    global CHECKED_OUT
+    with POOL_LOCK:
+        if POOL is None:
+            OpenPool()
+        pool, slots = POOL, SLOTS
+        CHECKED_OUT += 1
+    try:
+        slots.acquire()
+        try:
+            pg = pool.getconn()
+            # new connections have no idle time yet
+            if time.time() - IDLE_SINCE.get(pg, time.time()) > IDLE_CHECK:
+                try:
+                    pg.cursor().execute("select 1")
+                except psycopg2.Error:
+                    IDLE_SINCE.pop(pg, None)
+                    pool.putconn(pg, close=True)
+                    pg = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+    except Exception:
+        with POOL_LOCK:
+            CHECKED_OUT -= 1
+        raise
+    return pg
+
+## Hand a connection back to the pool.
+def PutConnection(pg, broken=False):
+    '''Hand a connection from GetConnection() back to the pool.
+
+    Args:
+      pg: The connection.
+      broken: True closes the connection instead of keeping it for reuse.
+    '''
+    global CHECKED_OUT
+    broken = broken or bool(pg.closed)
+    if broken:
+        IDLE_SINCE.pop(pg, None)
+    else:
+        IDLE_SINCE[pg] = time.time()
+    try:
+        POOL.putconn(pg, close=broken)
+    finally:
+        SLOTS.release()
+        with POOL_LOCK:
+            CHECKED_OUT -= 1
+
+## Tell a lost connection from an error of the database.
+def ConnectionLost(error, pg=None):
+    '''Return True if error means the database could not be reached.
+
+    The connection is closed, or the error did not come from the database,
+    which sends a SQLSTATE with every error it raises. A cancelled statement
+    or a serialization failure is never a lost connection, it is not fixed by
+    trying again.
+
+    Args:
+      error: The exception raised.
+      pg: The connection it was raised on, if there was one.
+    '''
+    if isinstance(error, psycopg2.InterfaceError):
+        return True
+    if pg is not None and pg.closed:
+        return True
+    if isinstance(error, (psycopg2.extensions.QueryCanceledError,
+                          psycopg2.extensions.TransactionRollbackError)):
+        return False
+    return isinstance(error, psycopg2.OperationalError) and error.pgcode is None
+
+## Run database work on a pooled connection.
+def Run(work):
+    '''Run work in a transaction on a pooled connection.
+
+    If the connection turns out to be lost while work runs the work is tried
+    once more on a new connection, nothing of the first try was committed
+    then. A connection lost during the commit is not tried again, the commit
+    may have gone through.
+
+    Args:
+      work: A function taking a cursor, called once or twice.
 
     Returns:
-      A list of dictionaries, where each dictionary has a 'content' key
-      pointing to the post content, and 'time' key pointing to the time
-      it was posted.
+      What work returns.
     '''
-    pg = psycopg2.connect("dbname = forum")
-    c = pg.cursor()
-    c.execute("select content, time from posts order by time desc")
-    DB = c.fetchall()
-    pg.close()
+    for attempt in range(2):
+        pg = GetConnection()
+        committed = broken = committing = False
+        try:
+            result = work(pg.cursor())
+            committing = True
+            pg.commit()
+            committed = True
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if not ConnectionLost(e, pg):
+                raise
+            broken = True
+            if committing or attempt == 1:
+                raise
+        finally:
+            # the connection goes back to the pool even if the rollback fails
+            try:
+                if not committed and not broken and not pg.closed:
+                    pg.rollback()
+            except psycopg2.Error:
+                broken = True
+            finally:
+                PutConnection(pg, broken)
 
-    posts = [{'content': str(row[1]), 'time': str(row[0])} for row in DB]
-    posts.sort(key=lambda row: row['time'], reverse=True)
-    return posts
+## Stream a page of posts from database.
+def IterPosts(before=None, limit=PAGE_SIZE):
+    '''Yield a page of posts one at a time, with the newest first.
+
+    Pages are found by the key of the last post of the previous page, using
+    the index on (time, id), so every page costs the same however many posts
+    there are. The posts are read from a server-side cursor ITERSIZE rows at
+    a time, so the first post is there as soon as the database found it and
+    a page is never held in memory as a whole.
+
+    The connection is taken from the pool until the generator is exhausted or
+    closed.
+
+    Args:
+      before: The key (time, id) of the last post of the previous page, see
+        ParseKey(). None for the first page.
+      limit: The number of posts on the page, at most MAX_PAGE_SIZE.
+
+    Yields:
+      Tuples (html, key) of the rendered post and the key of the post. One
+      post more than limit is yielded when there are older posts, its key is
+      not the one for the next page.
+    '''
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    pg = GetConnection()
+    broken = False
+    try:
+        c = pg.cursor('posts')
+        c.itersize = ITERSIZE
+        c.execute(*PageQuery(before, limit))
+        for row in c:
+            yield (row[3] or RenderPost(row[0], row[1]), (row[1], row[2]))
+        c.close()
+        pg.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        broken = ConnectionLost(e, pg)
+        raise
+    finally:
+        # the connection goes back to the pool even if the rollback fails
+        try:
+            if not broken and not pg.closed:
+                # ends the transaction when the reader stopped early
+                pg.rollback()
+        except psycopg2.Error:
+            broken = True
+        finally:
+            PutConnection(pg, broken)
+
+def PageQuery(before, limit):
+    '''Return the query and arguments for a page of posts.
+
+    One row more than the page is selected, it tells whether there is a next
+    page.
+    '''
+    if before is None:
+        return ("select content, time, id, html from posts"
+                " order by time desc, id desc limit %s", (limit + 1, ))
+    return ("select content, time, id, html from posts"
+            " where (time, id) < (%s, %s)"
+            " order by time desc, id desc limit %s",
+            (before[0], before[1], limit + 1))
+
+## Search posts.
+def SearchPosts(query, page=0, limit=PAGE_SIZE):
+    '''Search the posts for words, the best matching posts first.
+
+    The words are looked up in the GIN index on the search column, only the
+    matching posts are read and ranked.
+
+    Args:
+      query: The words to search for, posts have to contain all of them.
+      page: The number of the page of results, starting at 0, at most
+        MAX_SEARCH_PAGE.
+      limit: The number of posts on a page, at most MAX_PAGE_SIZE.
+
+    Returns:
+      A tuple (posts, more):
+        posts: A list of dictionaries, where each dictionary has a 'content'
+          key pointing to the post content, a 'time' key pointing to the time
+          it was posted, an 'id' key and an 'html' key pointing to the
+          rendered post.
+        more: True if there is a next page of results, never for page
+          MAX_SEARCH_PAGE.
+    '''
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    page = max(0, min(int(page), MAX_SEARCH_PAGE))
+    def work(c):
+        # one row more than the page tells whether there is a next page
+        c.execute("select content, time, id, html from posts,"
+                  " plainto_tsquery(%s, %s) as q"
+                  " where search @@ q"
+                  " order by ts_rank(search, q) desc, time desc, id desc"
+                  " limit %s offset %s",
+                  (SEARCH_CONFIG, query, limit + 1, page * limit))
+        return c.fetchall()
+    DB = Run(work)
+
+    posts = [{'content': row[0], 'time': str(row[1]), 'id': row[2],
+              'html': row[3] or RenderPost(row[0], row[1])}
+             for row in DB[:limit]]
+    return posts, len(DB) > limit and page < MAX_SEARCH_PAGE
+
+## Keys of pages in URLs.
+def FormatKey(key):
+    '''Format the key (time, id) of a post as text for the before parameter.'''
+    return '%s,%d' % (key[0].isoformat(), key[1])
+
+def ParseKey(text):
+    '''Parse a key formatted by FormatKey(), returns None if it is not one.'''
+    try:
+        stamp, postid = text.rsplit(',', 1)
+        # isoformat() leaves out a whole second's microseconds
+        if '.' not in stamp:
+            stamp += '.000000'
+        return (datetime.datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S.%f'),
+                int(postid))
+    except ValueError:
+        return None
 
 ## Add a post to the database.
 def AddPost(content):
     '''Add a new post to the database.
 
+    With EnableAsyncWrites() the post is handed to the background writer and
+    is in the database shortly after this returns. The time of the post is
+    taken by the database when it is written.
+
     Args:
       content: The text content of the new post.
     '''
-    pg = psycopg2.connect("dbname = forum")
-    c = pg.cursor()
-    #t = time.strftime('%c', time.localtime())
+    writer = WRITER
+    # a writer that is being closed takes no more posts, they are written here
+    if writer is not None and writer.Add(content):
+        return
+    WritePosts([content])
+
+## Render a post.
+def RenderPost(content, time):
+    '''Return the HTML of a post for the forum page.
+
+    Args:
+      content: The cleaned content of the post.
+      time: The datetime it was posted.
+    '''
+    return POST % {'content': content, 'time': str(time)}
+
+## Insert posts in one statement.
+def WritePosts(posts):
+    '''Clean and render posts and insert them with one statement and one
+    commit.
+
+    The posts are stamped with the time of the database. Writers take turns
+    and the time is never before the newest post, so new posts are always
+    newer than every post there is and a page of older posts never changes
+    once it is shown. Reading posts is not held up by the lock.
+
+    Args:
+      posts: The contents of the posts.
+    '''
+    posts = [bleach.clean(content) for content in posts]
+    def work(c):
+        c.execute("lock table posts in share row exclusive mode;"
+                  " select greatest(localtimestamp, max(time)) from posts")
+        now = c.fetchone()[0]
+        values = ', '.join(c.mogrify("(%s, %s, %s)",
+                                     (content, now, RenderPost(content, now)))
+                           for content in posts)
+        c.execute("insert into posts (content, time, html) values " + values)
+    Run(work)
+
+## Write posts in batches in the background.
+class PostWriter(object):
+    '''Writes posts to the database in batches from a background thread.
+
+    A batch is written as soon as it has batch posts or its first post waited
+    interval seconds. Add() waits while the queue holds size posts. A batch
+    that fails because the database can not be reached is tried again until it
+    is written. A batch the database refuses is written one post at a time,
+    the posts it still refuses are logged and dropped so one bad post does not
+    stop the writer. Close() writes all posts that were added before
+    returning, the posts it could not write in time are logged instead.
+
+    Args:
+      batch: The most posts written with one statement and commit.
+      interval: The most seconds a post waits for a batch to fill up.
+      size: The most posts waiting to be written.
+      on_commit: Called without arguments after every written batch.
+    '''
+
+    def __init__(self, batch=BATCH_SIZE, interval=FLUSH_INTERVAL,
+                 size=QUEUE_SIZE, on_commit=None):
+        self.batch = batch
+        self.interval = interval
+        self.on_commit = on_commit
+        self.queue = Queue.Queue(size)
+        self.closed = False
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.Work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Add(self, post):
+        '''Queue the content of a post, waiting while the queue is full.
+
+        Returns:
+          False if the writer is closed and the post was not queued.
+        '''
+        # posts are queued under the lock, so none gets behind the end of
+        # the queue put there by Close()
+        with self.lock:
+            if self.closed:
+                return False
+            self.queue.put(post)
+            return True
+
+    def Close(self, timeout=CLOSE_TIMEOUT):
+        '''Write all queued posts and stop the background thread.
+
+        Posts that are not written after timeout seconds, e.g. because the
+        database is down, are logged to stderr and dropped, so the program
+        can exit.
+        '''
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                # set first, a full queue is emptied by dropping posts then
+                self.deadline = time.time() + timeout
+                self.queue.put(None)
+        self.thread.join(max(0, self.deadline - time.time()) + RETRY_INTERVAL)
+        if self.thread.is_alive():
+            # stuck writing a batch, drop what it did not get to
+            posts = []
+            try:
+                while True:
+                    post = self.queue.get_nowait()
+                    if post is not None:
+                        posts.append(post)
+            except Queue.Empty:
+                pass
+            self.Drop(posts)
+
+    def Expired(self):
+        '''Return True once Close() stopped waiting for the posts.'''
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def Drop(self, posts):
+        '''Log posts that are not written.'''
+        for post in posts:
+            sys.stderr.write("Post not written: %r\n" % (post, ))
+
+    def Work(self):
+        '''Background thread writing the queued posts.'''
+        stop = False
+        while not stop:
+            posts = [self.queue.get()]
+            if posts[0] is None:
+                break
+            deadline = time.time() + self.interval
+            while len(posts) < self.batch:
+                wait = deadline - time.time()
+                try:
+                    if wait > 0:
+                        post = self.queue.get(timeout=wait)
+                    else:
+                        post = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if post is None:
+                    stop = True
+                    break
+                posts.append(post)
+            self.Write(posts)
+
+    def Write(self, posts):
+        '''Write a batch, one post at a time if the database refuses it.'''
+        if self.Expired():
+            self.Drop(posts)
+            return
+        if not self.Insert(posts) and len(posts) > 1:
+            for post in posts:
+                self.Insert([post])
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def Insert(self, posts):
+        '''Insert posts, trying again while the database can not be reached.
+
+        The posts are logged and dropped when Close() stops waiting for them.
+
+        Returns:
+          False if the database refused the posts, a single post is dropped.
+        '''
+        while True:
+            try:
+                WritePosts(posts)
+                return True
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                if not ConnectionLost(e):
+                    if len(posts) == 1:
+                        sys.stderr.write("Dropped post: %r\n" % (posts[0], ))
+                    return False
+            if self.Expired():
+                self.Drop(posts)
+                return True
+            time.sleep(RETRY_INTERVAL)
+
+## Turn batched writes on and off.
+def EnableAsyncWrites(batch=BATCH_SIZE, interval=FLUSH_INTERVAL,
+                      size=QUEUE_SIZE, on_commit=None):
+    '''Have AddPost() hand posts to a PostWriter instead of writing them.
+
+    The posts still queued are written when DisableAsyncWrites() is called,
+    at the latest when the program exits, those not written within
+    CLOSE_TIMEOUT seconds are logged. See PostWriter for the arguments.
+    '''
+    global WRITER
+    DisableAsyncWrites()
+    WRITER = PostWriter(batch, interval, size, on_commit)
+
+def DisableAsyncWrites():
+    '''Write the queued posts and have AddPost() write posts at once again.'''
+    global WRITER
+    writer, WRITER = WRITER, None
+    if writer is not None:
+        writer.Close()
 
-    c.execute("insert into posts (content) values (%s)", (bleach.clean(content), ))
-    #DB.append((t, content))
-    pg.commit()
-    pg.close()
+atexit.register(DisableAsyncWrites)
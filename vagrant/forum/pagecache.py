@@ -0,0 +1,112 @@
+#
+# Caches of rendered pages for the web forum.
+#
+# Pages are cached under a key that includes the generation of the forum for
+# pages that change when a post is added. Adding a post starts a new
+# generation, so those pages are rendered again and old ones are never served.
+# Generations start at a random number, so one started after a restart, in
+# another server process or after Redis lost its keys is not mistaken for an
+# old one whose pages a browser may still have.
+#
+
+import collections
+import random
+import threading
+
+## Pages kept by a PageCache
+CACHE_SIZE = 256
+
+## Seconds a page is kept in Redis
+REDIS_EXPIRE = 3600
+
+## Bits of the random first generation
+GENERATION_BITS = 48
+
+
+def FirstGeneration():
+    '''Return a random generation to start counting from.'''
+    return random.SystemRandom().getrandbits(GENERATION_BITS)
+
+
+## Rendered pages in the memory of the server process.
+class PageCache(object):
+    '''Rendered pages kept in process memory, least recently used go first.
+
+    Args:
+      size: The number of pages to keep.
+    '''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.pages = collections.OrderedDict()
+        self.generation = FirstGeneration()
+        self.lock = threading.Lock()
+
+    def Generation(self):
+        '''Return the current generation.'''
+        return self.generation
+
+    def Invalidate(self):
+        '''Start a new generation, after a post was added.'''
+        with self.lock:
+            self.generation += 1
+
+    def Get(self, key):
+        '''Return the page cached under key, or None.'''
+        with self.lock:
+            page = self.pages.pop(key, None)
+            if page is not None:
+                self.pages[key] = page
+            return page
+
+    def Put(self, key, page):
+        '''Cache page under key.'''
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = page
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+
+## Rendered pages in Redis, shared by all server processes.
+class RedisPageCache(object):
+    '''Rendered pages kept in a Redis server.
+
+    The generation is kept in Redis as well, a post added through any of the
+    server processes starts a new generation for all of them.
+
+    Args:
+      host, port, db: The Redis server to use.
+      prefix: Prepended to all Redis keys of the cache.
+      expire: Seconds a page is kept.
+    '''
+
+    def __init__(self, host='localhost', port=6379, db=0, prefix='forum:',
+                 expire=REDIS_EXPIRE):
+        import redis
+        self.redis = redis.StrictRedis(host=host, port=port, db=db)
+        self.prefix = prefix
+        self.expire = expire
+
+    def Generation(self):
+        '''Return the current generation.'''
+        generation = self.redis.get(self.prefix + 'generation')
+        if generation is None:
+            self.redis.setnx(self.prefix + 'generation', FirstGeneration())
+            generation = self.redis.get(self.prefix + 'generation')
+        return int(generation)
+
+    def Invalidate(self):
+        '''Start a new generation, after a post was added.'''
+        pipe = self.redis.pipeline()
+        pipe.setnx(self.prefix + 'generation', FirstGeneration())
+        pipe.incr(self.prefix + 'generation')
+        pipe.execute()
+
+    def Get(self, key):
+        '''Return the page cached under key, or None.'''
+        return self.redis.get(self.prefix + key)
+
+    def Put(self, key, page):
+        '''Cache page under key.'''
+        self.redis.setex(self.prefix + key, self.expire, page)
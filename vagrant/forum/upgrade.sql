@@ -0,0 +1,44 @@
+-- Brings a posts table created by an older forum.sql up to date, run it on an
+-- existing forum database:
+--
+--   psql forum -f upgrade.sql
+--
+-- Every step is skipped when it was done before, so it can be run on a table
+-- that is up to date already. Posts without html are rendered when they are
+-- read, they are not backfilled.
+
+do $$
+begin
+  if not exists (select 1 from pg_index
+                  where indrelid = 'posts'::regclass and indisprimary) then
+    alter table posts add primary key (id);
+  end if;
+  if not exists (select 1 from information_schema.columns
+                  where table_name = 'posts' and column_name = 'html') then
+    alter table posts add column html text;
+  end if;
+  if not exists (select 1 from information_schema.columns
+                  where table_name = 'posts' and column_name = 'search') then
+    alter table posts add column search tsvector;
+  end if;
+  if not exists (select 1 from pg_class where relname = 'posts_time_id') then
+    create index posts_time_id on posts (time desc, id desc);
+  end if;
+  if not exists (select 1 from pg_class where relname = 'posts_search') then
+    create index posts_search on posts using gin (search);
+  end if;
+  if not exists (select 1 from pg_trigger
+                  where tgrelid = 'posts'::regclass
+                    and tgname = 'posts_search') then
+    create trigger posts_search before insert or update on posts
+      for each row execute procedure
+      tsvector_update_trigger(search, 'pg_catalog.english', content);
+  end if;
+end
+$$;
+
+-- the words of the posts added before the search column
+update posts set search = to_tsvector('pg_catalog.english', coalesce(content, ''))
+ where search is null;
+
+analyze posts;
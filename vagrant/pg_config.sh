@@ -1,5 +1,5 @@
 apt-get -qqy update
-apt-get -qqy install postgresql python-psycopg2
+apt-get -qqy install postgresql python-psycopg2 python-numpy
 apt-get -qqy install python-flask python-sqlalchemy
 apt-get -qqy install python-pip
 pip install bleach
@@ -14,6 +14,7 @@ su postgres -c 'createuser -dRS vagrant'
 su vagrant -c 'createdb'
 su vagrant -c 'createdb forum'
 su vagrant -c 'psql forum -f /vagrant/forum/forum.sql'
+su vagrant -c 'psql forum -f /vagrant/forum/upgrade.sql'
 
 vagrantTip="[35m[1mThe shared directory is located at /vagrant\nTo access your shared files: cd /vagrant(B[m"
 echo -e $vagrantTip > /etc/motd
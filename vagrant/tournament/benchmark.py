@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- simulate Swiss-system tournaments of growing size and time
+# the tournament.py functions round by round.
+#
+# Every simulated tournament is created with createTournament() and deleted
+# again afterwards, point the benchmark at a scratch database with --dsn:
+#
+#   python benchmark.py --dsn "dbname=tournament_bench" --sizes 100 1000 10000
+#
+# Results are written as JSON so runs of different releases can be diffed.
+# Peak memory is the peak of the whole process up to the end of a tournament.
+#
+
+import argparse
+import json
+import math
+import platform
+import random
+import resource
+import time
+
+import instrument
+import tournament
+
+
+def peakMemory():
+    """Returns the peak resident memory of the process in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(tournament_id, method, *args):
+    """Calls a Tournament method in a session of its own, like the module
+    level functions do.
+
+    Returns:
+      A tuple (result, timing), timing is a dict with the wall time in seconds,
+      the database round trips, rows fetched and connections opened of the
+      call.
+    """
+    before = instrument.counts()
+    start = time.time()
+    with tournament.Tournament(tournament_id) as t:
+        result = getattr(t, method)(*args)
+    seconds = time.time() - start
+    timing = instrument.since(before)
+    timing['seconds'] = seconds
+    return result, timing
+
+
+def playMatches(pairings, draws, rng):
+    """Returns a random result for every pairing as (p1, p2, win) tuples."""
+    results = []
+    for (id1, name1, id2, name2) in pairings:
+        if rng.random() < draws:
+            results.append((id1, id2, None))
+        else:
+            results.append((id1, id2, rng.choice((id1, id2))))
+    return results
+
+
+def simulate(players, rounds, strategy, draws, rng):
+    """Runs one tournament and returns its timings.
+
+    Returns:
+      A dict with the timing of the registration and per round the timings of
+      playerStandings(), swissPairings() and reportMatches().
+    """
+    tid = tournament.createTournament("Benchmark %d players" % players)
+    names = ["Pony %d" % i for i in range(players)]
+    ids, register = measure(tid, 'registerPlayers', names)
+
+    result = {'players': players,
+              'rounds': [],
+              'register': register}
+    for n in range(1, rounds + 1):
+        standings, standingsTime = measure(tid, 'playerStandings')
+        pairings, pairingTime = measure(tid, 'swissPairings', strategy)
+        results = playMatches(pairings, draws, rng)
+        ignored, reportTime = measure(tid, 'reportMatches', results)
+        result['rounds'].append({'round': n,
+                                 'standings': standingsTime,
+                                 'pairing': pairingTime,
+                                 'report': reportTime})
+        print "  round %d: standings %.3fs, pairing %.3fs, report %.3fs" % (
+            n, standingsTime['seconds'], pairingTime['seconds'],
+            reportTime['seconds'])
+    wrong, rebuildTime = measure(tid, 'rebuildStandings')
+    result['consistent'] = wrong == []
+    result['peak_memory_kb'] = peakMemory()
+    tournament.deleteTournament(tid)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time simulated Swiss-system tournaments.')
+    parser.add_argument('--dsn', default=tournament.DSN,
+                        help='database to run against')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000],
+                        help='number of players of the simulated tournaments')
+    parser.add_argument('--rounds', type=int, default=None,
+                        help='rounds per tournament, default log2(players)')
+    parser.add_argument('--strategy', default='backtrack',
+                        help='pairing strategy passed to swissPairings()')
+    parser.add_argument('--draws', type=float, default=0.1,
+                        help='chance of a match ending in a draw')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json',
+                        help='file the JSON results are written to')
+    args = parser.parse_args()
+
+    tournament.configurePool(args.dsn,
+                             connection_factory=instrument.CountingConnection)
+    rng = random.Random(args.seed)
+    report = {'python': platform.python_version(),
+              'dsn': args.dsn,
+              'strategy': args.strategy,
+              'draws': args.draws,
+              'seed': args.seed,
+              'tournaments': []}
+    for players in args.sizes:
+        rounds = args.rounds or int(math.ceil(math.log(players, 2)))
+        print "%d players, %d rounds" % (players, rounds)
+        report['tournaments'].append(
+            simulate(players, rounds, args.strategy, args.draws, rng))
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print "Results written to %s" % args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+#
+# instrument.py -- opt-in instrumentation of tournament.py
+#
+# enable() replaces the public functions of tournament.py and the pairRound()
+# of the pairing engine by wrappers that record the wall time, database round
+# trips, rows fetched and connections opened of every call. disable() puts the
+# original functions back, so nothing is measured or slowed down while
+# instrumentation is off.
+#
+#   with instrument.recording() as stats:
+#       tournament.registerPlayers(names)
+#       tournament.swissPairings()
+#   print stats.table()
+#
+# The counters are process wide and calls are tracked as one call stack,
+# instrument a single thread at a time.
+#
+
+import functools
+import inspect
+import time
+
+import psycopg2.extensions
+import psycopg2.pool
+
+import pairing
+import tournament
+
+## Counters kept by the counting connections and cursors
+COUNTERS = ('queries', 'rows', 'connections')
+
+## Calls of this function at the top level start a new round
+ROUND_FUNCTION = 'swissPairings'
+
+_counts = dict.fromkeys(COUNTERS, 0)
+
+## Stats being recorded and the functions they replaced, see enable()
+_stats = None
+_originals = {}
+_poolKwargs = None
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends and the rows it fetches.
+
+    A fetch from a named cursor is a round trip of its own and counted as one.
+    """
+
+    def execute(self, query, vars=None):
+        _counts['queries'] += 1
+        return psycopg2.extensions.cursor.execute(self, query, vars)
+
+    def fetched(self, rows):
+        _counts['rows'] += rows
+        if self.name:
+            _counts['queries'] += 1
+
+    def fetchone(self):
+        row = psycopg2.extensions.cursor.fetchone(self)
+        self.fetched(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = psycopg2.extensions.cursor.fetchmany(self, size)
+        self.fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = psycopg2.extensions.cursor.fetchall(self)
+        self.fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Connection that hands out counting cursors and counts itself, commits
+    and rollbacks."""
+
+    def __init__(self, *args, **kwargs):
+        psycopg2.extensions.connection.__init__(self, *args, **kwargs)
+        _counts['connections'] += 1
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return psycopg2.extensions.connection.cursor(self, *args, **kwargs)
+
+    def commit(self):
+        _counts['queries'] += 1
+        return psycopg2.extensions.connection.commit(self)
+
+    def rollback(self):
+        _counts['queries'] += 1
+        return psycopg2.extensions.connection.rollback(self)
+
+
+def counts():
+    """Returns a copy of the counters of the counting connections."""
+    return dict(_counts)
+
+
+def since(before):
+    """Returns how much the counters went up since counts() returned before."""
+    return dict((name, _counts[name] - before[name]) for name in COUNTERS)
+
+
+def emptyStats():
+    stats = dict.fromkeys(COUNTERS, 0)
+    stats.update(calls=0, seconds=0.0)
+    return stats
+
+
+class Stats(object):
+    """Recorded calls, cumulative per function and per round.
+
+    Attributes:
+      functions: dict mapping each function name to a dict with the calls,
+        seconds, queries, rows and connections of all its calls. Calls made
+        by another instrumented function are included in both.
+      rounds: list of dicts like functions, a new round starts with every
+        swissPairings() call. Round 0 holds what was done before the first.
+      total: the stats of all top level calls together.
+    """
+
+    def __init__(self):
+        self.functions = {}
+        self.rounds = [{}]
+        self.total = emptyStats()
+        self.depth = 0
+
+    def call(self, name, function, args=(), kwargs={}, calls=1):
+        """Calls function and records the call under name."""
+        outer = self.depth == 0
+        if outer and calls and name == ROUND_FUNCTION:
+            self.rounds.append({})
+        before = counts()
+        start = time.time()
+        self.depth += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            seconds = time.time() - start
+            used = since(before)
+            targets = [self.functions.setdefault(name, emptyStats()),
+                       self.rounds[-1].setdefault(name, emptyStats())]
+            if outer:
+                targets.append(self.total)
+            for stats in targets:
+                stats['calls'] += calls
+                stats['seconds'] += seconds
+                for counter in COUNTERS:
+                    stats[counter] += used[counter]
+
+    def summary(self):
+        """Returns the stats as a dict that can be written as JSON."""
+        return {'functions': self.functions,
+                'rounds': self.rounds,
+                'total': self.total}
+
+    def table(self):
+        """Returns the stats per function as text, slowest function first."""
+        lines = ["%-24s %7s %10s %8s %10s %5s" % ('function', 'calls',
+                                                 'seconds', 'queries',
+                                                 'rows', 'conns')]
+        functions = sorted(self.functions.items(),
+                           key=lambda item: -item[1]['seconds'])
+        for name, stats in functions + [('total', self.total)]:
+            lines.append("%-24s %7d %10.4f %8d %10d %5d" % (
+                name, stats['calls'], stats['seconds'], stats['queries'],
+                stats['rows'], stats['connections']))
+        return '\n'.join(lines)
+
+
+def wrap(stats, name, function):
+    """Returns a function recording every call of function in stats.
+
+    Generators are measured while they run, not only when created.
+    """
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def iterate(*args, **kwargs):
+            rows = stats.call(name, function, args, kwargs)
+            while True:
+                try:
+                    row = stats.call(name, next, (rows,), calls=0)
+                except StopIteration:
+                    return
+                yield row
+        return iterate
+
+    @functools.wraps(function)
+    def call(*args, **kwargs):
+        return stats.call(name, function, args, kwargs)
+    return call
+
+
+def publicFunctions():
+    """Returns the names of the public functions of tournament.py."""
+    return [name for name, value in vars(tournament).items()
+            if inspect.isfunction(value) and not name.startswith('_')
+            and value.__module__ == tournament.__name__]
+
+
+def enable(stats=None):
+    """Start recording calls.
+
+    The connection pool is reopened with counting connections, the pool
+    settings are restored by disable(). Reopening the pool would close the
+    connections of open sessions, so it is refused while there are any.
+
+    Args:
+      stats: Stats to add the calls to, default new ones.
+
+    Returns:
+      The Stats the calls are recorded in.
+
+    Raises:
+      psycopg2.pool.PoolError: connections are in use, nothing was changed.
+    """
+    global _stats, _poolKwargs
+    if tournament.connectionsInUse():
+        raise psycopg2.pool.PoolError(
+            "can not instrument while %d connections are in use" %
+            tournament.connectionsInUse())
+    if _stats is not None:
+        disable()
+    # settings of a pool that disable() could not restore are still kept
+    if _poolKwargs is None:
+        _poolKwargs = tournament.POOL_KWARGS
+    tournament.configurePool(**dict(_poolKwargs,
+                                    connection_factory=CountingConnection))
+    _stats = stats or Stats()
+    for name in publicFunctions():
+        _originals[(tournament, name)] = getattr(tournament, name)
+    _originals[(pairing, 'pairRound')] = pairing.pairRound
+    for (module, name), function in _originals.items():
+        label = name if module is tournament else 'pairing.' + name
+        setattr(module, name, wrap(_stats, label, function))
+    return _stats
+
+
+def disable():
+    """Stop recording calls and put the original functions back.
+
+    The pool settings are restored when no connections are in use, otherwise
+    the counting connections are kept until the next enable() or disable().
+
+    Returns:
+      The Stats the calls were recorded in, or None if not enabled.
+    """
+    global _stats, _poolKwargs
+    for (module, name), function in _originals.items():
+        setattr(module, name, function)
+    _originals.clear()
+    if _poolKwargs is not None and not tournament.connectionsInUse():
+        tournament.configurePool(**_poolKwargs)
+        _poolKwargs = None
+    stats, _stats = _stats, None
+    return stats
+
+
+class recording(object):
+    """Context manager recording calls while its block runs.
+
+        with instrument.recording() as stats:
+            ...
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats
+
+    def __enter__(self):
+        return enable(self.stats)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        disable()
+        return False
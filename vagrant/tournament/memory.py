@@ -0,0 +1,382 @@
+#
+# memory.py -- in-memory backend for the Swiss-system tournament
+#
+# MemoryTournament has the same methods as a tournament.Tournament session
+# but keeps the tournament in memory, without a database round trip per call.
+# What is reported can be written behind to PostgreSQL, in a background thread
+# at every round or when flush() is called.
+#
+
+import array
+import itertools
+import Queue
+import threading
+
+import pairing
+import tournament
+
+
+class MemoryTournament(object):
+    """A tournament kept in memory.
+
+    The standings are kept in compact per player arrays indexed by the
+    position of the player, player id minus the id of the first player, and
+    are updated as results are reported just like the standings table.
+
+    There are no transactions, commit() and rollback() do nothing and a
+    session that raises keeps what was reported before the error. Rows that
+    would be refused by the database raise ValueError, or BatchError for the
+    bulk functions, before anything is changed.
+
+    Args:
+      persist: callable returning a tournament.Tournament session to write the
+        tournament to, e.g. tournament.Tournament. None keeps the tournament
+        in memory only.
+      flush: 'round' writes to persist in the background every time a round
+        is paired, 'manual' only when flush() is called.
+    """
+
+    def __init__(self, persist=None, flush='round'):
+        if flush not in ('round', 'manual'):
+            raise ValueError("unknown flush mode %r" % (flush,))
+        self.persist = persist
+        self.flushMode = flush
+        self.nextid = 1
+        self.ops = []
+        self.failed = []
+        self.dbids = {}
+        self.queue = None
+        self.error = None
+        self.clearPlayers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def commit(self):
+        """Nothing to commit, results are applied when reported."""
+
+    def rollback(self):
+        """Reported results can not be rolled back."""
+
+    def close(self):
+        """Write what is left to persist and wait for the writes."""
+        self.flush()
+
+    def clearPlayers(self):
+        self.base = self.nextid
+        self.names = []
+        self.wins = array.array('i')
+        self.losses = array.array('i')
+        self.draws = array.array('i')
+        self.byes = array.array('i')
+        self.omw = array.array('i')
+        self.opponents = []
+        self.decided = []
+        self.clearMatches()
+
+    def clearMatches(self):
+        for column in (self.wins, self.losses, self.draws, self.byes, self.omw):
+            column[:] = array.array('i', [0]) * len(self.names)
+        self.opponents = [set() for name in self.names]
+        # positions of the opponents in matches that were not a draw
+        self.decided = [[] for name in self.names]
+        self.matches = []
+        self.matchups = set()
+        self.byelist = []
+
+    def index(self, playerid):
+        """Returns the position of a player in the arrays."""
+        i = playerid - self.base
+        if not 0 <= i < len(self.names):
+            raise ValueError("unknown player %r" % (playerid,))
+        return i
+
+    def checkMatch(self, player1, player2, win, matchups):
+        """Raise ValueError for a match the database would refuse."""
+        self.index(player1)
+        self.index(player2)
+        if player1 == player2:
+            raise ValueError("player %s can not play against themselves" %
+                             player1)
+        if win not in (player1, player2, None):
+            raise ValueError("winner %s did not play the match" % win)
+        if (min(player1, player2), max(player1, player2)) in matchups:
+            raise ValueError("players %s and %s have played before" %
+                             (player1, player2))
+
+    def record(self, op, row):
+        """Remember a change for the next flush to persist."""
+        if self.persist is not None:
+            self.ops.append((op, row))
+
+    def deleteMatches(self):
+        """See tournament.deleteMatches()."""
+        self.clearMatches()
+        self.record('deleteMatches', None)
+
+    def deletePlayers(self):
+        """See tournament.deletePlayers()."""
+        self.clearPlayers()
+        self.record('deletePlayers', None)
+
+    def countPlayers(self):
+        """See tournament.countPlayers()."""
+        return len(self.names)
+
+    def validMatchups(self, playerid, wins):
+        """See tournament.validMatchups()."""
+        played = self.opponents[self.index(playerid)]
+        return [(self.base + i,) for i in range(len(self.names))
+                if self.wins[i] + self.byes[i] == wins
+                and self.base + i != playerid
+                and self.base + i not in played]
+
+    def opponentsOf(self, playerid):
+        """See tournament.opponentsOf()."""
+        return list(self.opponents[self.index(playerid)])
+
+    def havePlayed(self, player1, player2):
+        """See tournament.havePlayed()."""
+        return player2 in self.opponents[self.index(player1)]
+
+    def registerPlayer(self, name):
+        """See tournament.registerPlayer()."""
+        playerid = self.nextid
+        self.nextid += 1
+        self.names.append(name)
+        for column in (self.wins, self.losses, self.draws, self.byes, self.omw):
+            column.append(0)
+        self.opponents.append(set())
+        self.decided.append([])
+        self.record('players', (playerid, name))
+        return playerid
+
+    def registerPlayers(self, names):
+        """See tournament.registerPlayers()."""
+        return [self.registerPlayer(name) for name in names]
+
+    def playerStandings(self, tiebreaks=None):
+        """See tournament.playerStandings()."""
+        standings = []
+        for i, name in enumerate(self.names):
+            wins, losses, draws = self.wins[i], self.losses[i], self.draws[i]
+            standings.append((self.base + i, name, wins + self.byes[i], losses,
+                              draws, wins + losses + draws, self.omw[i]))
+        if tiebreaks is not None:
+            import tiebreaks as tb
+            return tb.sortStandings(standings, self.matches, self.byelist,
+                                    tiebreaks)
+        standings.sort(key=lambda row: (-row[2], -row[6], -row[5], row[0]))
+        return standings
+
+    def rebuildStandings(self):
+        """See tournament.rebuildStandings()."""
+        current = self.playerStandings()
+        matches, byelist = self.matches, self.byelist
+        self.clearMatches()
+        for match in matches:
+            self.applyMatch(*match)
+        for playerid in byelist:
+            self.byes[self.index(playerid)] += 1
+        self.byelist = byelist
+        rebuilt = dict((row[0], row) for row in self.playerStandings())
+        return sorted(row[0] for row in current if rebuilt[row[0]] != row)
+
+    def applyMatch(self, player1, player2, win):
+        """Add a checked match to the standings."""
+        a = self.index(player1)
+        b = self.index(player2)
+        self.matches.append((player1, player2, win))
+        self.matchups.add((min(player1, player2), max(player1, player2)))
+        self.opponents[a].add(player2)
+        self.opponents[b].add(player1)
+        if win is None:
+            self.draws[a] += 1
+            self.draws[b] += 1
+            return
+        # same update as the standings_match trigger in tournament.sql
+        w, l = (a, b) if win == player1 else (b, a)
+        for opponent in self.decided[w]:
+            self.omw[opponent] += 1
+        self.omw[w] += self.wins[l]
+        self.omw[l] += self.wins[w] + 1
+        self.wins[w] += 1
+        self.losses[l] += 1
+        self.decided[w].append(l)
+        self.decided[l].append(w)
+
+    def reportMatch(self, player1, player2, win=None):
+        """See tournament.reportMatch()."""
+        self.checkMatch(player1, player2, win, self.matchups)
+        self.applyMatch(player1, player2, win)
+        self.record('matches', (player1, player2, win))
+
+    def reportMatches(self, matches):
+        """See tournament.reportMatches()."""
+        rows = [tuple(match) + (None,) * (3 - len(match)) for match in matches]
+        matchups = set(self.matchups)
+        for i, (player1, player2, win) in enumerate(rows):
+            try:
+                self.checkMatch(player1, player2, win, matchups)
+            except ValueError as e:
+                raise tournament.BatchError(i, rows[i], e)
+            matchups.add((min(player1, player2), max(player1, player2)))
+        for row in rows:
+            self.applyMatch(*row)
+            self.record('matches', row)
+
+    def reportBye(self, playerid):
+        """See tournament.reportBye()."""
+        self.byes[self.index(playerid)] += 1
+        self.byelist.append(playerid)
+        self.record('byes', playerid)
+
+    def reportByes(self, playerids):
+        """See tournament.reportByes()."""
+        playerids = list(playerids)
+        for i, playerid in enumerate(playerids):
+            try:
+                self.index(playerid)
+            except ValueError as e:
+                raise tournament.BatchError(i, playerid, e)
+        for playerid in playerids:
+            self.reportBye(playerid)
+
+    def playedMatchups(self):
+        """See tournament.playedMatchups()."""
+        matchups = []
+        for (player1, player2, win) in self.matches:
+            draw = 1 if win is None else None
+            matchups.append((player1, player2, draw))
+            matchups.append((player2, player1, draw))
+        matchups.sort(key=lambda row: row[0])
+        return matchups
+
+    def iterStandings(self, itersize=None):
+        """See tournament.iterStandings()."""
+        return iter(self.playerStandings())
+
+    def iterPlayedMatchups(self, itersize=None):
+        """See tournament.iterPlayedMatchups()."""
+        for i, played in enumerate(self.opponents):
+            decided = set(self.decided[i])
+            for opponent in played:
+                draw = None if opponent - self.base in decided else 1
+                yield (self.base + i, opponent, draw)
+
+    def iterMatches(self, itersize=None):
+        """See tournament.iterMatches()."""
+        return iter(self.matches)
+
+    def assignedByes(self):
+        """See tournament.assignedByes()."""
+        return [(playerid,) for playerid in self.byelist]
+
+    def pairingSnapshot(self):
+        """See tournament.pairingSnapshot()."""
+        opponents = dict((self.base + i, played)
+                         for i, played in enumerate(self.opponents))
+        return self.playerStandings(), opponents, list(self.byelist)
+
+    def swissPairings(self, strategy='random'):
+        """See tournament.swissPairings()."""
+        standings, opponents, byes = self.pairingSnapshot()
+        bye, matchups = pairing.pairRound(standings, opponents, byes, strategy)
+        if bye is not None:
+            self.reportBye(bye[0])
+        # the results of the last round are in, write them behind
+        if self.flushMode == 'round':
+            self.flush(wait=False)
+        return matchups
+
+    def flush(self, wait=True):
+        """Write what was reported since the last flush to persist.
+
+        The writes of one flush are done in a single session. Writes that
+        fail are kept and tried again, before anything reported later, by the
+        next flush.
+
+        Args:
+          wait: with False the writes are handed to a background thread, which
+            does them in order, and flush returns at once. An error of a
+            background write is raised by the next flush that waits, no more
+            writes are done in the background until then.
+        """
+        if self.persist is None:
+            return
+        ops, self.ops = self.ops, []
+        if not wait:
+            if self.queue is None:
+                self.queue = Queue.Queue()
+                worker = threading.Thread(target=self.writer)
+                worker.daemon = True
+                worker.start()
+            self.queue.put(ops)
+            return
+        if self.queue is not None:
+            self.queue.join()
+        # the background thread is idle now
+        ops, self.failed = self.failed + ops, []
+        if self.error is not None:
+            error, self.error = self.error, None
+            self.failed = ops
+            raise error
+        try:
+            self.write(ops)
+        except Exception:
+            self.failed = ops
+            raise
+
+    def writer(self):
+        """Background thread doing the writes handed over by flush()."""
+        while True:
+            ops = self.queue.get()
+            ops, self.failed = self.failed + ops, []
+            try:
+                if self.error is None:
+                    self.write(ops)
+                else:
+                    self.failed = ops
+            except Exception as e:
+                self.failed = ops
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, ops):
+        """Write changes to persist with the bulk functions of a session.
+
+        The database ids of new players are only remembered once the session
+        committed, a session that fails leaves nothing behind to retry.
+        """
+        if not ops:
+            return
+        added = {}
+
+        def dbid(playerid):
+            if playerid is None:
+                return None
+            if playerid in added:
+                return added[playerid]
+            return self.dbids[playerid]
+
+        with self.persist() as t:
+            for op, group in itertools.groupby(ops, key=lambda op: op[0]):
+                rows = [row for (op, row) in group]
+                if op == 'players':
+                    ids = t.registerPlayers([name for (playerid, name) in rows])
+                    added.update(zip([playerid for (playerid, name) in rows],
+                                     ids))
+                elif op == 'matches':
+                    t.reportMatches([(dbid(p1), dbid(p2), dbid(win))
+                                     for (p1, p2, win) in rows])
+                elif op == 'byes':
+                    t.reportByes([dbid(playerid) for playerid in rows])
+                elif op == 'deleteMatches':
+                    t.deleteMatches()
+                elif op == 'deletePlayers':
+                    t.deletePlayers()
+        self.dbids.update(added)
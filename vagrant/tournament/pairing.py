@@ -0,0 +1,389 @@
+#
+# pairing.py -- pairing engine for the Swiss-system tournament
+#
+# Works on the rows returned by playerStandings() and an index of the played
+# matchups, without touching the database.
+#
+
+import collections
+import itertools
+import random
+
+## Random picks tried in a score group before listing all eligible opponents
+ATTEMPTS = 8
+
+## Pairing strategies accepted by pairRound()
+STRATEGIES = ('random', 'backtrack')
+
+
+class PairingError(IndexError):
+    """No eligible opponent is left for a player."""
+
+
+def opponentIndex(playedmatchups):
+    """Returns a dict mapping each player id to the set of its opponents' ids.
+
+    Args:
+      playedmatchups: rows starting with (id, opponent), like the rows
+        returned by playedMatchups().
+    """
+    opponents = {}
+    for row in playedmatchups:
+        opponents.setdefault(row[0], set()).add(row[1])
+    return opponents
+
+
+def chooseBye(standings, byes, rng=random):
+    """Returns the standings row of the player that receives the bye.
+
+    In the first round the bye is assigned at random, after that to the lowest
+    standing player who has not received one before.
+    """
+    if standings[0][5] == 0:
+        return rng.choice(standings)
+    byes = set(byes)
+    return next(row for row in reversed(standings) if row[0] not in byes)
+
+
+class ScoreGroups(object):
+    """The unpaired players bucketed by their wins.
+
+    Each bucket is a list with a position map next to it, a player is removed
+    in constant time by moving the last player of the bucket into its place.
+    """
+
+    def __init__(self, standings):
+        self.buckets = {}
+        self.position = {}
+        for row in standings:
+            bucket = self.buckets.setdefault(row[2], [])
+            self.position[row[0]] = len(bucket)
+            bucket.append(row[0])
+
+    def __len__(self):
+        return len(self.position)
+
+    def remove(self, wins, playerid):
+        """Take a player out of the bucket for wins."""
+        bucket = self.buckets[wins]
+        index = self.position.pop(playerid)
+        last = bucket.pop()
+        if last != playerid:
+            bucket[index] = last
+            self.position[last] = index
+
+    def choose(self, wins, played, rng=random):
+        """Returns a random player with wins that is not in played, or None.
+
+        A few random picks almost always find an eligible opponent as a player
+        has only played a few of the players in a score group. Only when they
+        all fail are the eligible opponents listed.
+        """
+        bucket = self.buckets.get(wins)
+        if not bucket:
+            return None
+        for attempt in range(ATTEMPTS):
+            pick = rng.choice(bucket)
+            if pick not in played:
+                return pick
+        possibilities = [opp for opp in bucket if opp not in played]
+        if possibilities:
+            return rng.choice(possibilities)
+        return None
+
+
+def randomPairings(standings, opponents, rng=random):
+    """Pairs the players in standings, see swissPairings().
+
+    Starting at the bottom of the standings each player is paired with a
+    random opponent they have not played, with the same wins or, if no
+    unpaired player has the same wins, with one more win.
+
+    Args:
+      standings: rows as returned by playerStandings(), an even number.
+      opponents: dict of sets of opponents, see opponentIndex().
+      rng: source of random choices.
+
+    Returns:
+      A list of (id1, name1, id2, name2) tuples.
+
+    Raises:
+      PairingError: a player has already played all eligible opponents.
+    """
+    groups = ScoreGroups(standings)
+    names = dict((row[0], row[1]) for row in standings)
+    matchups = []
+    for player in reversed(standings):
+        playerID = player[0]
+        playerWins = player[2]
+        if playerID not in groups.position:
+            continue # paired as an opponent already
+        groups.remove(playerWins, playerID)
+        if not groups:
+            break
+
+        if groups.buckets.get(playerWins):
+            wins = playerWins
+        else:
+            wins = playerWins + 1
+        opponent = groups.choose(wins, opponents.get(playerID, ()), rng)
+        if opponent is None:
+            raise PairingError("no eligible opponent left for player %s" %
+                               playerID)
+
+        groups.remove(wins, opponent)
+        matchups.append((playerID, player[1], opponent, names[opponent]))
+    return matchups
+
+
+class Matching(object):
+    """A perfect matching of the players in standings on the graph of the
+    players that have not played each other.
+
+    The graph is nearly complete, it is never built, a player's neighbours are
+    the players they have not played. The players that are still to be paired
+    are kept in a doubly linked list in standings order, position n is the
+    sentinel before the first and after the last player.
+    """
+
+    def __init__(self, standings, opponents):
+        self.n = n = len(standings)
+        self.ids = [row[0] for row in standings]
+        self.played = [opponents.get(playerid, ()) for playerid in self.ids]
+        self.mate = [-1] * n
+        self.nxt = list(range(1, n + 1)) + [0]
+        self.prv = [n] + list(range(n))
+
+    def unlink(self, i):
+        self.nxt[self.prv[i]] = self.nxt[i]
+        self.prv[self.nxt[i]] = self.prv[i]
+
+    def relink(self, i):
+        self.nxt[self.prv[i]] = i
+        self.prv[self.nxt[i]] = i
+
+    def following(self, i):
+        """Yields the unpaired players after i in standings order."""
+        i = self.nxt[i]
+        while i != self.n:
+            yield i
+            i = self.nxt[i]
+
+    def neighbours(self, v, free=()):
+        """Yields the unpaired players v has not played, free players first."""
+        played = self.played[v]
+        for to in itertools.chain(free, self.following(self.n)):
+            if to != v and self.ids[to] not in played:
+                yield to
+
+    def greedy(self):
+        """Matches each player with the first unmatched player below them
+        they have not played.
+
+        Returns:
+          The players left unmatched.
+        """
+        mate = self.mate
+        unmatched = []
+        for p in self.following(self.n):
+            if mate[p] != -1:
+                continue
+            for q in self.following(p):
+                if mate[q] == -1 and self.ids[q] not in self.played[p]:
+                    mate[p] = q
+                    mate[q] = p
+                    break
+            else:
+                unmatched.append(p)
+        return unmatched
+
+    def augment(self, root, free):
+        """Looks for an augmenting path from root to one of the other free
+        players with Edmonds' blossom algorithm and flips it.
+
+        Returns:
+          True if the path was found and root is matched now.
+        """
+        mate = self.mate
+        parent = {}
+        base = {root: root}
+        outer = set([root])
+        tree = [root]
+        queue = collections.deque([root])
+
+        def baseOf(v):
+            return base.get(v, v)
+
+        def lca(a, b):
+            seen = set()
+            while True:
+                a = baseOf(a)
+                seen.add(a)
+                if mate[a] == -1:
+                    break
+                a = parent[mate[a]]
+            while True:
+                b = baseOf(b)
+                if b in seen:
+                    return b
+                b = parent[mate[b]]
+
+        def markPath(v, b, child, blossom):
+            while baseOf(v) != b:
+                blossom.add(baseOf(v))
+                blossom.add(baseOf(mate[v]))
+                parent[v] = child
+                child = mate[v]
+                v = parent[mate[v]]
+
+        while queue:
+            v = queue.popleft()
+            for to in self.neighbours(v, free):
+                if baseOf(v) == baseOf(to) or mate[v] == to:
+                    continue
+                if to == root or (mate[to] != -1 and mate[to] in parent):
+                    # an odd cycle, contract it into a blossom
+                    b = lca(v, to)
+                    blossom = set()
+                    markPath(v, b, to, blossom)
+                    markPath(to, b, v, blossom)
+                    for i in tree:
+                        if baseOf(i) in blossom:
+                            base[i] = b
+                            if i not in outer:
+                                outer.add(i)
+                                queue.append(i)
+                elif to not in parent:
+                    parent[to] = v
+                    tree.append(to)
+                    if mate[to] == -1:
+                        while to != -1:
+                            v = parent[to]
+                            after = mate[v]
+                            mate[to] = v
+                            mate[v] = to
+                            to = after
+                        return True
+                    outer.add(mate[to])
+                    tree.append(mate[to])
+                    queue.append(mate[to])
+        return False
+
+    def fix(self, p, q):
+        """Pairs p with q if the players left can still all be paired.
+
+        p and q are taken out of the matching, which leaves their mates
+        without one. The rest can be paired only if an augmenting path
+        connects those two, it is searched from the one that has played more
+        players as it has the fewest neighbours.
+
+        Returns:
+          True if p and q were paired, otherwise nothing is changed.
+        """
+        mate = self.mate
+        if mate[p] == q:
+            self.unlink(p)
+            self.unlink(q)
+            return True
+        pmate, qmate = mate[p], mate[q]
+        self.unlink(p)
+        self.unlink(q)
+        mate[pmate] = mate[qmate] = -1
+        free = sorted((pmate, qmate), key=lambda i: -len(self.played[i]))
+        if self.augment(free[0], free[1:]):
+            mate[p] = q
+            mate[q] = p
+            return True
+        mate[pmate], mate[qmate] = p, q
+        self.relink(q)
+        self.relink(p)
+        return False
+
+
+def backtrackPairings(standings, opponents):
+    """Pairs the players in standings with the closest opponent they can.
+
+    First a complete pairing is found as a perfect matching on the graph of
+    the players that have not played each other: the players are paired
+    greedily and the ones left over are matched by augmenting paths, found
+    with Edmonds' blossom algorithm. If a player can not be matched there is
+    no complete pairing.
+
+    Then from the top of the standings down, the order in which Swiss rules
+    give players priority, each player is paired with the closest player
+    below them whose pairing still leaves a complete pairing for the rest.
+    That is checked by repairing the matching with one augmenting path, so a
+    wrong choice is backed out of at once instead of being found at the
+    bottom of the standings. Players are paired any number of wins apart if
+    there is no other way.
+
+    As the players have only played a few of the players around them the
+    closest candidate can almost always be taken and an augmenting path is a
+    single edge, a round is paired in near-linear time.
+
+    Args:
+      standings: rows as returned by playerStandings(), an even number.
+      opponents: dict of sets of opponents, see opponentIndex().
+
+    Returns:
+      A list of (id1, name1, id2, name2) tuples.
+
+    Raises:
+      PairingError: there is no complete pairing.
+    """
+    if len(standings) % 2 != 0:
+        raise ValueError("can not pair an uneven number of players")
+    matching = Matching(standings, opponents)
+    # players that have played the most have the fewest possible opponents,
+    # they are matched first
+    unmatched = sorted(matching.greedy(),
+                       key=lambda i: len(matching.played[i]))
+    while unmatched:
+        root = unmatched.pop()
+        if matching.mate[root] != -1:
+            continue
+        if not matching.augment(root, unmatched):
+            raise PairingError("no complete pairing exists, player %s is"
+                               " left without an opponent" %
+                               matching.ids[root])
+
+    pairs = []
+    while matching.nxt[matching.n] != matching.n:
+        p = matching.nxt[matching.n]
+        for q in matching.following(p):
+            if (matching.ids[q] not in matching.played[p] and
+                    matching.fix(p, q)):
+                pairs.append((p, q))
+                break
+        else:
+            raise PairingError("no eligible opponent left for player %s" %
+                               matching.ids[p])
+
+    return [(standings[p][0], standings[p][1], standings[q][0], standings[q][1])
+            for p, q in pairs]
+
+
+def pairRound(standings, opponents, byes, strategy='random', rng=random):
+    """Assigns the bye, if needed, and pairs the other players.
+
+    Args:
+      standings: rows as returned by playerStandings().
+      opponents: dict of sets of opponents, see opponentIndex().
+      byes: ids of the players who have received a bye before.
+      strategy: 'random' for randomPairings(), 'backtrack' for
+        backtrackPairings().
+      rng: source of random choices.
+
+    Returns:
+      A tuple (bye, matchups), bye is the standings row of the player that
+      receives the bye or None for an even number of players.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("unknown pairing strategy %r" % (strategy,))
+    bye = None
+    if len(standings) % 2 != 0:
+        bye = chooseBye(standings, byes, rng)
+        standings = [row for row in standings if row[0] != bye[0]]
+    if strategy == 'backtrack':
+        return bye, backtrackPairings(standings, opponents)
+    return bye, randomPairings(standings, opponents, rng)
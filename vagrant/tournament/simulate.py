@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# simulate.py -- Monte Carlo study of Swiss-system tournaments
+#
+# Plays thousands of independent tournaments to see how pairing and tiebreak
+# rules work out for players of known strength. Every tournament is played in
+# memory with memory.MemoryTournament, so the tournaments share no state and
+# are spread over a pool of processes:
+#
+#   python simulate.py --players 64 --events 10000 --processes 8
+#
+# The final standings are sorted on the default tiebreaks, or on a chain given
+# with --tiebreaks, e.g. --tiebreaks median,buchholz,sb.
+#
+# The results of a player are given by seed, the strongest player is seed 0.
+#
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import time
+
+import numpy
+
+import memory
+import tiebreaks
+
+
+def strengths(players, spread):
+    """Returns the Elo rating of every seed, evenly spaced around 1500."""
+    return 1500 + spread * numpy.linspace(1, -1, players)
+
+
+def parseTiebreaks(text):
+    """Returns the tiebreak chain of a comma separated list of names."""
+    chain = tuple(name.strip() for name in text.split(',') if name.strip())
+    for name in chain:
+        if name not in tiebreaks.TIEBREAKS:
+            raise argparse.ArgumentTypeError(
+                "unknown tiebreak %r, choose from %s" % (
+                    name, ', '.join(tiebreaks.TIEBREAKS)))
+    return chain
+
+
+def playEvent(players, rounds, strategy, ratings, draws, rng, chain=None):
+    """Plays one tournament in memory.
+
+    Matches are won with the chance given by the Elo ratings of the players,
+    or drawn with chance draws. The final standings are sorted on the
+    tiebreak chain, or on the default order of playerStandings() if None.
+
+    Returns:
+      An array with the finish place of every seed, 0 is first place.
+    """
+    t = memory.MemoryTournament()
+    ids = t.registerPlayers(["Seed %d" % seed for seed in range(players)])
+    first = ids[0]
+    for n in range(rounds):
+        results = []
+        for (id1, name1, id2, name2) in t.swissPairings(strategy):
+            difference = ratings[id2 - first] - ratings[id1 - first]
+            expected = 1 / (1 + 10 ** (difference / 400.0))
+            if rng.random() < draws:
+                results.append((id1, id2, None))
+            elif rng.random() < expected:
+                results.append((id1, id2, id1))
+            else:
+                results.append((id1, id2, id2))
+        t.reportMatches(results)
+    places = numpy.empty(players, dtype=numpy.intp)
+    for place, row in enumerate(t.playerStandings(chain)):
+        places[row[0] - first] = place
+    return places
+
+
+def playEvents(task):
+    """Plays a chunk of tournaments in a worker process.
+
+    Returns:
+      A players x players array, counting for every seed how often it
+      finished in every place.
+    """
+    seed, events, players, rounds, strategy, spread, draws, chain = task
+    # the pairings use the random module, seed it per chunk as well
+    random.seed(seed)
+    rng = random.Random(seed)
+    ratings = strengths(players, spread)
+    places = numpy.array([playEvent(players, rounds, strategy, ratings,
+                                    draws, rng, chain)
+                          for n in range(events)])
+    # count (seed, place) pairs of all events at once
+    cells = numpy.arange(players) * players + places
+    return numpy.bincount(cells.ravel(),
+                          minlength=players * players).reshape(players, players)
+
+
+def simulate(players, rounds, events, strategy='backtrack', spread=200,
+             draws=0.05, processes=None, chunk=50, seed=0, chain=None):
+    """Plays events tournaments spread over a pool of processes.
+
+    Args:
+      players: players per tournament.
+      rounds: rounds per tournament.
+      events: number of tournaments to play.
+      strategy: pairing strategy, see swissPairings().
+      spread: Elo difference between the middle and the strongest seed.
+      draws: chance of a match ending in a draw.
+      processes: size of the process pool, default the number of cores.
+      chunk: tournaments played per task handed to a process.
+      seed: seed of the random numbers, the same seed gives the same results.
+      chain: tiebreak names to sort the final standings on, see
+        tiebreaks.TIEBREAKS. None keeps the order of playerStandings().
+
+    Returns:
+      A players x players array, counting for every seed how often it
+      finished in every place.
+    """
+    tasks = []
+    for n, start in enumerate(range(0, events, chunk)):
+        tasks.append((seed * 1000003 + n, min(chunk, events - start), players,
+                      rounds, strategy, spread, draws, chain))
+    counts = numpy.zeros((players, players), dtype=numpy.int64)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(playEvents, tasks):
+            counts += result
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+
+def summary(counts, top=8):
+    """Returns the finish distribution of every seed as a list of dicts."""
+    events = counts.sum(axis=1).astype(float)
+    places = numpy.arange(counts.shape[1])
+    mean = counts.dot(places) / events
+    deviation = numpy.sqrt(counts.dot(places ** 2) / events - mean ** 2)
+    wins = counts[:, 0] / events
+    topRate = counts[:, :top].sum(axis=1) / events
+    return [{'seed': seed,
+             'mean_place': mean[seed],
+             'place_deviation': deviation[seed],
+             'win_rate': wins[seed],
+             'top_%d_rate' % top: topRate[seed]}
+            for seed in range(counts.shape[0])]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Monte Carlo study of Swiss-system tournaments.')
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=None,
+                        help='rounds per tournament, default log2(players)')
+    parser.add_argument('--events', type=int, default=1000,
+                        help='number of tournaments to play')
+    parser.add_argument('--strategy', default='backtrack',
+                        help='pairing strategy passed to swissPairings()')
+    parser.add_argument('--spread', type=float, default=200,
+                        help='Elo difference between the middle and top seed')
+    parser.add_argument('--draws', type=float, default=0.05,
+                        help='chance of a match ending in a draw')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='size of the process pool, default all cores')
+    parser.add_argument('--chunk', type=int, default=50,
+                        help='tournaments per task handed to a process')
+    parser.add_argument('--top', type=int, default=8,
+                        help='report how often a seed finishes in this top')
+    parser.add_argument('--tiebreaks', type=parseTiebreaks, default=None,
+                        help='comma separated tiebreak chain to sort the '
+                             'final standings on, e.g. median,buchholz,sb')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='write the finish distributions to this JSON file')
+    args = parser.parse_args()
+
+    rounds = args.rounds or int(math.ceil(math.log(args.players, 2)))
+    start = time.time()
+    counts = simulate(args.players, rounds, args.events, args.strategy,
+                      args.spread, args.draws, args.processes, args.chunk,
+                      args.seed, args.tiebreaks)
+    seconds = time.time() - start
+    print "%d tournaments of %d players and %d rounds in %.1fs, %.1f per second" % (
+        args.events, args.players, rounds, seconds, args.events / seconds)
+
+    seeds = summary(counts, args.top)
+    print "seed  mean place  win rate  top %d rate" % args.top
+    for row in seeds:
+        print "%4d  %10.2f  %8.3f  %10.3f" % (row['seed'], row['mean_place'],
+                                             row['win_rate'],
+                                             row['top_%d_rate' % args.top])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'players': args.players,
+                       'rounds': rounds,
+                       'events': args.events,
+                       'strategy': args.strategy,
+                       'spread': args.spread,
+                       'draws': args.draws,
+                       'tiebreaks': args.tiebreaks,
+                       'seed': args.seed,
+                       'seconds': seconds,
+                       'places': counts.tolist(),
+                       'seeds': seeds}, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
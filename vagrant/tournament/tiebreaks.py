@@ -0,0 +1,136 @@
+#
+# tiebreaks.py -- tiebreak scores for the Swiss-system tournament
+#
+# The reported matches are loaded into arrays of edges, one edge per player
+# per match, and every tiebreak is computed for all players at once with
+# numpy.bincount over those edges instead of a query per tiebreak.
+#
+
+import itertools
+
+import numpy
+
+## Tiebreaks accepted in a chain, see compute() for their definition
+TIEBREAKS = ('omw', 'omwp', 'sb', 'buchholz', 'median', 'matches')
+
+## Chain of the standings table: OMW, then matches played
+DEFAULT_CHAIN = ('omw', 'matches')
+
+## Lowest win percentage of an opponent counted by OMW%
+OMWP_FLOOR = 1 / 3.0
+
+
+def positions(ids, playerids):
+    """Returns the position in ids of every id in playerids.
+
+    Player ids of a tournament are close together, a lookup table from id to
+    position is indexed instead of searching ids.
+    """
+    lowest = ids.min()
+    table = numpy.zeros(ids.max() - lowest + 1, dtype=numpy.intp)
+    table[ids - lowest] = numpy.arange(len(ids))
+    return table[playerids - lowest]
+
+
+def compute(ids, matches, byes=()):
+    """Computes all tiebreaks for the players in ids.
+
+    A win scores 1 point, a draw half a point and a bye counts as a win, as
+    it does in the standings.
+
+      omw: match wins of the opponents of matches that were not a draw, the
+        OMW of the standings table.
+      omwp: average win percentage of the opponents, points per match
+        played, each at least OMWP_FLOOR.
+      sb: Sonneborn-Berger, the points of the beaten opponents plus half the
+        points of the drawn opponents.
+      buchholz: the points of all opponents.
+      median: median-Buchholz, Buchholz without the opponent with the most and
+        the one with the fewest points, once a player has had three opponents.
+      matches: the matches played.
+
+    Args:
+      ids: player ids.
+      matches: (p1, p2, win) tuples as stored by reportMatches(), win is None
+        for a draw.
+      byes: ids of the players who received a bye, once per bye.
+
+    Returns:
+      A dict mapping each tiebreak to an array of scores in the order of ids.
+    """
+    ids = numpy.asarray(ids, dtype=numpy.int64)
+    n = len(ids)
+    # a draw has win None, which becomes nan
+    rows = numpy.fromiter(itertools.chain.from_iterable(matches),
+                          dtype=float, count=3 * len(matches)).reshape(-1, 3)
+    one = positions(ids, rows[:, 0].astype(numpy.int64))
+    two = positions(ids, rows[:, 1].astype(numpy.int64))
+    # one edge from each player of a match to their opponent
+    player = numpy.concatenate((one, two))
+    opponent = numpy.concatenate((two, one))
+    winner = numpy.concatenate((rows[:, 2], rows[:, 2]))
+    result = numpy.where(numpy.isnan(winner), 0.5,
+                         (winner == ids[player]).astype(float))
+
+    played = numpy.bincount(player, minlength=n)
+    points = numpy.bincount(player, weights=result, minlength=n)
+    wins = numpy.bincount(player, weights=result == 1, minlength=n)
+    byes = positions(ids, numpy.asarray(byes, dtype=numpy.int64))
+    score = points + numpy.bincount(byes, minlength=n)
+
+    decided = result != 0.5
+    omw = numpy.bincount(player[decided], weights=wins[opponent[decided]],
+                         minlength=n)
+
+    percentage = numpy.maximum(points / numpy.maximum(played, 1), OMWP_FLOOR)
+    omwp = (numpy.bincount(player, weights=percentage[opponent], minlength=n) /
+            numpy.maximum(played, 1))
+
+    faced = score[opponent]
+    buchholz = numpy.bincount(player, weights=faced, minlength=n)
+    sb = numpy.bincount(player, weights=result * faced, minlength=n)
+
+    # highest and lowest opponent per player, over the edges sorted by player.
+    # reduceat needs increasing starts, so only players with a match get one.
+    faced = faced[numpy.argsort(player)]
+    active = numpy.flatnonzero(played)
+    starts = (numpy.cumsum(played) - played)[active]
+    median = buchholz.copy()
+    if len(active):
+        cut = played[active] >= 3
+        median[active[cut]] -= (numpy.maximum.reduceat(faced, starts)[cut] +
+                                numpy.minimum.reduceat(faced, starts)[cut])
+
+    return {'omw': omw,
+            'omwp': omwp,
+            'sb': sb,
+            'buchholz': buchholz,
+            'median': median,
+            'matches': played}
+
+
+def sortStandings(standings, matches, byes=(), chain=DEFAULT_CHAIN):
+    """Sorts standings rows on wins and then on a chain of tiebreaks.
+
+    Players tied on wins and on every tiebreak of the chain are sorted by id.
+
+    Args:
+      standings: rows as returned by playerStandings().
+      matches: (p1, p2, win) tuples of the reported matches.
+      byes: ids of the players who received a bye, once per bye.
+      chain: tiebreak names from TIEBREAKS, the highest score first.
+
+    Returns:
+      The rows of standings in their new order.
+    """
+    for name in chain:
+        if name not in TIEBREAKS:
+            raise ValueError("unknown tiebreak %r" % (name,))
+    if not standings:
+        return []
+    ids = numpy.array([row[0] for row in standings], dtype=numpy.int64)
+    wins = numpy.array([row[2] for row in standings])
+    scores = compute(ids, matches, byes)
+    # lexsort sorts on the last key first
+    keys = [ids] + [-scores[name] for name in reversed(chain)] + [-wins]
+    return [standings[i] for i in numpy.lexsort(keys)]
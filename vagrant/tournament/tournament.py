@@ -3,54 +3,669 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import csv
+import itertools
+import json
+import threading
+
 import psycopg2
-import random
+import psycopg2.pool
+
+import pairing
+
+## Connection pool settings, see configurePool()
+DSN = "dbname=tournament"
+POOL_MIN = 1
+POOL_MAX = 10
+POOL_KWARGS = {}
+
+## Tournament used by the module level functions, created by tournament.sql
+DEFAULT_TOURNAMENT = 1
+
+## Rows per statement for the bulk report functions
+BATCH_SIZE = 1000
+
+## Rows fetched per round trip by the iter functions
+ITERSIZE = 2000
+
+## Columns of the rows written by exportStandings() and exportMatches()
+STANDINGS_COLUMNS = ('id', 'name', 'wins', 'losses', 'draws', 'matches', 'omw')
+MATCH_COLUMNS = ('p1', 'p2', 'win')
+
+_pool = None
+
+## Connections taken from the pool by sessions and not handed back yet
+_inUse = 0
+_inUseLock = threading.Lock()
+
+## Numbers the server-side cursors, their names must differ within a session
+_cursorNumbers = itertools.count(1)
+
+## Pairing state per tournament id, see PairingState
+_pairingCache = {}
+_pairingLock = threading.Lock()
+
+## Backend of the module level functions, see setBackend()
+_backend = None
+
+
+def configurePool(dsn=None, minconn=None, maxconn=None, **kwargs):
+    """Change the settings of the connection pool.
+
+    Any open pool is closed, the next session creates a new one with the
+    given settings. Extra keyword arguments are passed on to
+    psycopg2.connect() for every connection the pool opens.
+
+    Raises:
+      psycopg2.pool.PoolError: connections of the open pool are in use, they
+        would be closed under their sessions.
+    """
+    global DSN, POOL_MIN, POOL_MAX, POOL_KWARGS
+    if _inUse:
+        raise psycopg2.pool.PoolError(
+            "can not configure the pool while %d connections are in use" %
+            _inUse)
+    closePool()
+    if dsn is not None:
+        DSN = dsn
+    if minconn is not None:
+        POOL_MIN = minconn
+    if maxconn is not None:
+        POOL_MAX = maxconn
+    POOL_KWARGS = kwargs
+
+
+def getPool():
+    """Returns the connection pool, it is created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, DSN,
+                                                     **POOL_KWARGS)
+    return _pool
+
+
+def closePool():
+    """Close all connections in the pool."""
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
 
 
 def connect():
-    """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    """Connect to the PostgreSQL database.  Returns a database connection.
+
+    The connection is a new one of its own with the settings of the pool, not
+    taken from the pool, close it when done. Sessions use pooled connections.
+    """
+    return psycopg2.connect(DSN, **POOL_KWARGS)
+
+
+def _getconn():
+    """Take a connection from the pool, hand it back with _putconn()."""
+    global _inUse
+    db = getPool().getconn()
+    with _inUseLock:
+        _inUse += 1
+    return db
+
+
+def _putconn(db):
+    """Return a connection obtained with _getconn() to the pool.
+
+    Connections that were closed or broken are discarded by the pool.
+    """
+    global _inUse
+    try:
+        getPool().putconn(db, close=bool(db.closed))
+    finally:
+        with _inUseLock:
+            _inUse -= 1
+
+
+def connectionsInUse():
+    """Returns the number of pooled connections sessions have not handed back."""
+    return _inUse
+
 
+def statements(rows):
+    """Returns the number of statements insertMany() inserts rows with."""
+    return (len(rows) + BATCH_SIZE - 1) // BATCH_SIZE
+
+
+class BatchError(ValueError):
+    """A row of a bulk report was refused by the database.
+
+    Nothing of the batch is written when this is raised.
+
+    Attributes:
+      index: position of the refused row in the batch
+      row: the refused row
+      cause: the database error for the row
+    """
+
+    def __init__(self, index, row, cause):
+        ValueError.__init__(self, "row %d %r: %s" % (index, row, cause))
+        self.index = index
+        self.row = row
+        self.cause = cause
+
+
+class PairingState(object):
+    """The opponents and byes of a tournament as of a tournament version.
+
+    Kept between sessions so pairing the next round does not read the whole
+    match history again. Sessions add the matches and byes they commit, a
+    state whose version is not the version in the database is read again.
+
+    A state is never changed once it is cached, other threads may be pairing
+    with its opponents. Committed matches and byes make a new state that
+    replaces it in the cache.
+
+    Attributes:
+      version: the version of the tournament in the tournaments table
+      opponents: dict mapping player ids to the frozenset of their opponents
+      byes: tuple of the ids of the players who have received a bye
+    """
+
+    def __init__(self, version, opponents, byes):
+        self.version = version
+        self.opponents = dict((playerid, frozenset(played))
+                              for playerid, played in opponents.items())
+        self.byes = tuple(byes)
+
+    def apply(self, writes, matches, byes):
+        """Returns the state after a session committed matches and byes with
+        writes statements."""
+        opponents = dict(self.opponents)
+        added = {}
+        for (player1, player2) in matches:
+            added.setdefault(player1, set()).add(player2)
+            added.setdefault(player2, set()).add(player1)
+        for playerid, played in added.items():
+            opponents[playerid] = opponents.get(playerid, frozenset()) | played
+        return PairingState(self.version + writes, opponents,
+                            self.byes + tuple(byes))
+
+
+class Tournament(object):
+    """A session on the tournament database.
+
+    All calls on a session share one pooled connection and one transaction.
+    Used as a context manager the transaction is committed when the block exits
+    normally and rolled back when it raises:
+
+        with Tournament() as t:
+            t.registerPlayer("Twilight Sparkle")
+            t.registerPlayer("Fluttershy")
+            pairings = t.swissPairings()
+
+    Outside of a with block call commit() and close() yourself. The methods are
+    the same as the module level functions, which each run in a session of
+    their own on the default tournament.
+
+    Args:
+      tournament_id: the tournament the session works on, see
+        createTournament().
+    """
+
+    def __init__(self, tournament_id=DEFAULT_TOURNAMENT):
+        self.tournament_id = int(tournament_id)
+        self.db = _getconn()
+        self.c = self.db.cursor()
+        self.forget()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+        return False
+
+    def commit(self):
+        """Commit the current transaction."""
+        version = None
+        if self.writes and not self.invalid:
+            # the version row stays locked by the writes until the commit
+            self.c.execute("select version from tournaments where id = %s;",
+                           (self.tournament_id,))
+            version = self.c.fetchone()[0]
+        self.db.commit()
+        with _pairingLock:
+            state = _pairingCache.get(self.tournament_id)
+            if self.invalid:
+                _pairingCache.pop(self.tournament_id, None)
+            elif state is not None and version is not None:
+                if state.version == version - self.writes:
+                    _pairingCache[self.tournament_id] = state.apply(
+                        self.writes, self.newMatches, self.newByes)
+                else:
+                    del _pairingCache[self.tournament_id]
+        self.forget()
+
+    def rollback(self):
+        """Roll back the current transaction."""
+        if not self.db.closed:
+            self.db.rollback()
+        self.forget()
+
+    def forget(self):
+        """Clear the changes of the transaction kept for the pairing cache."""
+        self.writes = 0
+        self.newMatches = []
+        self.newByes = []
+        self.invalid = False
+
+    def changed(self, writes, matches=(), byes=()):
+        """Note statements that changed the matches or byes, see commit()."""
+        self.writes += writes
+        self.newMatches.extend(matches)
+        self.newByes.extend(byes)
+
+    def close(self):
+        """Hand the connection back to the pool, uncommitted work is lost."""
+        if self.db is not None:
+            if not self.db.closed:
+                self.c.close()
+            _putconn(self.db)
+            self.db = None
+            self.c = None
+
+    def values(self, statement, template, rows, returning=''):
+        """Returns statement with a multi-row VALUES list for rows."""
+        values = ', '.join(self.c.mogrify(template, row) for row in rows)
+        return '%s values %s %s;' % (statement, values, returning)
+
+    def insertMany(self, statement, template, rows, returning=''):
+        """Insert rows with multi-row VALUES statements of BATCH_SIZE rows.
+
+        The insert is all or nothing, if the database refuses a row the rows
+        are replayed one at a time to find it and BatchError is raised.
+
+        Returns:
+          A list with the first column of the returning clause for every row.
+        """
+        rows = list(rows)
+        chunks = [rows[i:i + BATCH_SIZE]
+                  for i in range(0, len(rows), BATCH_SIZE)]
+        result = []
+        self.c.execute("savepoint bulk;")
+        for n, chunk in enumerate(chunks):
+            try:
+                self.c.execute(self.values(statement, template, chunk,
+                                           returning))
+            except psycopg2.DatabaseError as e:
+                self.c.execute("rollback to savepoint bulk;")
+                self.findBadRow(statement, template, chunks, n, e)
+            if returning:
+                result.extend(row[0] for row in self.c.fetchall())
+        self.c.execute("release savepoint bulk;")
+        return result
+
+    def findBadRow(self, statement, template, chunks, failed, error):
+        """Replay a failed insertMany() row by row and raise BatchError.
+
+        Runs right after rolling back to the bulk savepoint, the savepoint is
+        rolled back and released again before raising.
+        """
+        try:
+            for chunk in chunks[:failed]:
+                self.c.execute(self.values(statement, template, chunk))
+            offset = failed * BATCH_SIZE
+            for i, row in enumerate(chunks[failed]):
+                try:
+                    self.c.execute(self.values(statement, template, [row]))
+                except psycopg2.DatabaseError as e:
+                    raise BatchError(offset + i, row, e)
+        finally:
+            self.c.execute("rollback to savepoint bulk;")
+            self.c.execute("release savepoint bulk;")
+        # the failure did not come back one row at a time
+        raise error
+
+    def partition(self, table):
+        """Returns the name of the partition of table for this tournament."""
+        return '%s_%d' % (table, self.tournament_id)
+
+    def deleteMatches(self):
+        """See deleteMatches()."""
+        # truncate skips the standings triggers, reset the standings at once
+        self.c.execute("truncate %s, %s, %s;" % (self.partition('matches'),
+                                                 self.partition('opponents'),
+                                                 self.partition('byes')))
+        self.c.execute('''update standings
+                           set wins = 0, losses = 0, draws = 0, byes = 0, omw = 0
+                          where tournament_id = %s;''', (self.tournament_id,))
+        self.invalid = True
+
+    def deletePlayers(self):
+        """See deletePlayers()."""
+        self.c.execute("delete from players where tournament_id = %s;",
+                       (self.tournament_id,))
+        self.invalid = True
+
+    def countPlayers(self):
+        """See countPlayers()."""
+        self.c.execute("select count(*) from players where tournament_id = %s;",
+                       (self.tournament_id,))
+        return self.c.fetchone()[0]
+
+    def validMatchups(self, playerid, wins):
+        """See validMatchups()."""
+        query = '''select a.id from standings as a
+                   where a.tournament_id = %%s and a.wins + a.byes = %%s
+                    and a.id != %%s
+                    and not exists
+                     (select 1 from %s as o
+                       where o.id = %%s and o.opponent = a.id);
+                ''' % self.partition('opponents')
+        self.c.execute(query, (self.tournament_id, wins, playerid, playerid))
+        return self.c.fetchall()
+
+    def opponentsOf(self, playerid):
+        """See opponentsOf()."""
+        self.c.execute("select opponent from %s where id = %%s;" %
+                       self.partition('opponents'), (playerid,))
+        return [row[0] for row in self.c.fetchall()]
+
+    def havePlayed(self, player1, player2):
+        """See havePlayed()."""
+        self.c.execute("select 1 from %s where id = %%s and opponent = %%s;" %
+                       self.partition('opponents'), (player1, player2))
+        return self.c.fetchone() is not None
+
+    def registerPlayer(self, name):
+        """See registerPlayer()."""
+        self.c.execute('''insert into players (tournament_id, name)
+                          values (%s, %s) returning id;''',
+                       (self.tournament_id, name))
+        return self.c.fetchone()[0]
+
+    def registerPlayers(self, names):
+        """See registerPlayers()."""
+        return self.insertMany("insert into players (tournament_id, name)",
+                               "(%s, %s)",
+                               [(self.tournament_id, name) for name in names],
+                               "returning id")
+
+    def playerStandings(self, tiebreaks=None):
+        """See playerStandings()."""
+        # see view in tournament.sql
+        self.c.execute('''select id, name, wins, losses, draws, matchcount, omw
+                           from currentStandings
+                          where tournament_id = %s;''', (self.tournament_id,))
+        standings = self.c.fetchall()
+        if tiebreaks is None:
+            return standings
+        import tiebreaks as tb
+        self.c.execute("select p1, p2, win from %s;" % self.partition('matches'))
+        matches = self.c.fetchall()
+        self.c.execute("select id from %s;" % self.partition('byes'))
+        byes = [row[0] for row in self.c.fetchall()]
+        return tb.sortStandings(standings, matches, byes, tiebreaks)
+
+    def rebuildStandings(self):
+        """See rebuildStandings()."""
+        # keep writers out so the rebuild does not miss their updates
+        self.c.execute("lock table standings in exclusive mode;")
+        self.c.execute('''select id from
+                           (select * from computedStandings
+                             where tournament_id = %s) as a
+                           full join
+                           (select * from standings
+                             where tournament_id = %s) as b
+                           using (id)
+                          where (a.wins, a.losses, a.draws, a.byes, a.omw)
+                           is distinct from
+                                (b.wins, b.losses, b.draws, b.byes, b.omw)
+                          order by id;''',
+                       (self.tournament_id, self.tournament_id))
+        wrong = [row[0] for row in self.c.fetchall()]
+        if wrong:
+            self.c.execute("delete from standings where tournament_id = %s;",
+                           (self.tournament_id,))
+            self.c.execute('''insert into standings
+                              select * from computedStandings
+                               where tournament_id = %s;''',
+                           (self.tournament_id,))
+        return wrong
+
+    def reportMatch(self, player1, player2, win=None):
+        """See reportMatch()."""
+        self.c.execute('''insert into %s (tournament_id, p1, p2, win)
+                          values (%%s, %%s, %%s, %%s);''' % self.partition('matches'),
+                       (self.tournament_id, player1, player2, win))
+        self.changed(1, matches=[(player1, player2)])
+
+    def reportMatches(self, matches):
+        """See reportMatches()."""
+        rows = [(self.tournament_id,) + tuple(match) + (None,) * (3 - len(match))
+                for match in matches]
+        self.insertMany("insert into %s (tournament_id, p1, p2, win)" %
+                        self.partition('matches'), "(%s, %s, %s, %s)", rows)
+        self.changed(statements(rows),
+                     matches=[(row[1], row[2]) for row in rows])
+
+    def reportBye(self, playerid):
+        """See reportBye()."""
+        self.c.execute("insert into %s (tournament_id, id) values (%%s, %%s);" %
+                       self.partition('byes'), (self.tournament_id, playerid))
+        self.changed(1, byes=[playerid])
+
+    def reportByes(self, playerids):
+        """See reportByes()."""
+        playerids = list(playerids)
+        rows = [(self.tournament_id, playerid) for playerid in playerids]
+        self.insertMany("insert into %s (tournament_id, id)" %
+                        self.partition('byes'), "(%s, %s)", rows)
+        self.changed(statements(rows), byes=playerids)
+
+    def playedMatchups(self):
+        """See playedMatchups()."""
+        self.c.execute("select id, opponent, draw from %s order by id;" %
+                       self.partition('opponents'))
+        return self.c.fetchall()
+
+    def stream(self, query, args=None, itersize=None):
+        """Yields the rows of query from a server-side cursor.
+
+        Only itersize rows are held in memory at a time. The cursor lives in
+        the transaction of the session, finish iterating before committing.
+        Every stream has a cursor of its own, streams can be read side by side.
+        """
+        c = self.db.cursor('stream_%d' % next(_cursorNumbers))
+        c.itersize = itersize or ITERSIZE
+        try:
+            c.execute(query, args)
+            for row in c:
+                yield row
+        finally:
+            c.close()
+
+    def iterStandings(self, itersize=None):
+        """See iterStandings()."""
+        return self.stream('''select id, name, wins, losses, draws,
+                                  matchcount, omw
+                             from currentStandings
+                            where tournament_id = %s;''',
+                           (self.tournament_id,), itersize)
+
+    def iterPlayedMatchups(self, itersize=None):
+        """See iterPlayedMatchups()."""
+        return self.stream("select id, opponent, draw from %s order by id;" %
+                           self.partition('opponents'), None, itersize)
+
+    def iterMatches(self, itersize=None):
+        """See iterMatches()."""
+        return self.stream("select p1, p2, win from %s;" %
+                           self.partition('matches'), None, itersize)
+
+    def assignedByes(self):
+        """See assignedByes()."""
+        self.c.execute("select id from %s;" % self.partition('byes'))
+        return self.c.fetchall()
+
+    def pairingSnapshot(self):
+        """See pairingSnapshot()."""
+        # the cache is of committed work, a session that wrote reads it all
+        pending = self.writes or self.invalid
+        state = _pairingCache.get(self.tournament_id)
+        if state is not None and not pending:
+            self.c.execute('''select id, name, wins, losses, draws, matchcount,
+                                     omw,
+                                     (select version from tournaments
+                                       where id = %s)
+                                from currentStandings
+                               where tournament_id = %s;''',
+                           (self.tournament_id, self.tournament_id))
+            rows = self.c.fetchall()
+            if rows and rows[0][7] == state.version:
+                return ([row[:7] for row in rows], dict(state.opponents),
+                        list(state.byes))
+
+        self.c.execute('''select *, (select version from tournaments
+                                       where id = %s)
+                            from pairingSnapshot
+                           where tournament_id = %s;''',
+                       (self.tournament_id, self.tournament_id))
+        standings = []
+        opponents = {}
+        byes = []
+        rows = self.c.fetchall()
+        for row in rows:
+            standings.append(row[:7])
+            opponents[row[0]] = set(row[8])
+            if row[7]:
+                byes.append(row[0])
+        if rows and not pending:
+            # the state takes copies, the caller may change what it returns
+            with _pairingLock:
+                _pairingCache[self.tournament_id] = PairingState(
+                    rows[0][-1], opponents, byes)
+        return standings, opponents, byes
+
+    def swissPairings(self, strategy='random'):
+        """See swissPairings()."""
+        standings, opponents, byes = self.pairingSnapshot()
+
+        # give bye, the player is left out of the pairings
+        bye, matchups = pairing.pairRound(standings, opponents, byes, strategy)
+        if bye is not None:
+            self.reportBye(bye[0])
+        return matchups
+
+
+def setBackend(name, **kwargs):
+    """Choose where the module level functions keep the tournament.
+
+    The memory backend in use is closed first, writing what it did not write
+    yet to persist. If that fails its error is raised and the backend is kept,
+    so nothing reported is lost.
+
+    At the end of an event call flushBackend(), a memory backend with
+    flush='round' only writes in the background when a round is paired, the
+    results of the last round are not written before.
+
+    Args:
+      name: 'postgres' (the default) runs every call in a Tournament session
+        of its own, 'memory' keeps the tournament in a memory.MemoryTournament
+        without a database round trip per call.
+      kwargs: passed on to MemoryTournament, e.g. persist=Tournament to write
+        the tournament behind to PostgreSQL.
+    """
+    global _backend
+    if name not in ('postgres', 'memory'):
+        raise ValueError("unknown backend %r" % (name,))
+    flushBackend()
+    if name == 'postgres':
+        _backend = None
+    else:
+        import memory
+        _backend = memory.MemoryTournament(**kwargs)
+
+def flushBackend():
+    """Write what the module level functions reported to the database.
+
+    Waits for the writes of a memory backend with persist, raising the error
+    of a write that failed. Nothing to do for the postgres backend, which
+    writes every call at once.
+    """
+    if _backend is not None:
+        _backend.close()
+
+def session():
+    """Returns the session the module level functions run in."""
+    if _backend is None:
+        return Tournament()
+    return _backend
+
+def createTournament(name):
+    """Creates a tournament with its own players, matches and byes.
+
+    The matches and byes of every tournament are kept in partitions of their
+    own, so working on one tournament never reads the rows of another.
+
+    Args:
+      name: name of the tournament (need not be unique).
+
+    Returns:
+      The id of the tournament, pass it to Tournament() to work on it.
+    """
+    with Tournament() as t:
+        t.c.execute("select create_tournament(%s);", (name,))
+        return t.c.fetchone()[0]
+
+def deleteTournament(tournament_id):
+    """Deletes a tournament by dropping its partitions, and its players."""
+    with Tournament() as t:
+        t.c.execute("select drop_tournament(%s);", (tournament_id,))
+    with _pairingLock:
+        _pairingCache.pop(int(tournament_id), None)
+
+def archiveTournament(tournament_id):
+    """Archives a tournament.
+
+    Its matches and byes partitions are detached and kept as plain tables, the
+    players and their standings stay.
+    """
+    with Tournament() as t:
+        t.c.execute("select archive_tournament(%s);", (tournament_id,))
 
 def deleteMatches():
-    """Remove all the match records from the database."""
-    db = connect()
-    c = db.cursor()
-    c.execute("delete from matches;")
-    c.execute("delete from byes;")
-    db.commit()
-    db.close()
+    """Remove all the match records of the tournament from the database."""
+    with session() as t:
+        t.deleteMatches()
 
 def deletePlayers():
-    """Remove all the player records from the database."""
-    db = connect()
-    c = db.cursor()
-    c.execute("delete from players;")
-    db.commit()
-    db.close()
+    """Remove all the player records of the tournament from the database."""
+    with session() as t:
+        t.deletePlayers()
 
 def countPlayers():
     """Returns the number of players currently registered."""
-    db = connect()
-    c = db.cursor()
-    c.execute("select count(*) from players;")
-    result = c.fetchone()
-    db.close()
-    return result[0]
+    with session() as t:
+        return t.countPlayers()
 
 def validMatchups(playerid, wins):
     """Returns valid matchups from player standings and played matchups."""
-    db = connect()
-    c = db.cursor()
-    query = '''select a.id from
-                (select id from playerStandings where wins = %s and id != %s) as a
-               where a.id not in
-                (select opponent from playedMatchups where id = %s);
-            '''
-    c.execute(query, (wins, playerid, playerid))
-    matchups = c.fetchall()
-    db.close()
-    return matchups
+    with session() as t:
+        return t.validMatchups(playerid, wins)
+
+def opponentsOf(playerid):
+    """Returns a list with the ids of the players a player has played."""
+    with session() as t:
+        return t.opponentsOf(playerid)
+
+def havePlayed(player1, player2):
+    """Returns True if the two players have played each other."""
+    with session() as t:
+        return t.havePlayed(player1, player2)
 
 def registerPlayer(name):
     """Adds a player to the tournament database.
@@ -60,14 +675,29 @@ def registerPlayer(name):
 
     Args:
       name: the player's full name (need not be unique).
+
+    Returns:
+      The id the database assigned to the player.
+    """
+    with session() as t:
+        return t.registerPlayer(name)
+
+def registerPlayers(names):
+    """Adds many players to the tournament database in one transaction.
+
+    Args:
+      names: iterable with the full names of the players.
+
+    Returns:
+      A list with the ids the database assigned, in the order of names.
+
+    Raises:
+      BatchError: a name was refused, none of the players are added.
     """
-    db = connect()
-    c = db.cursor()
-    c.execute("insert into players (name) values (%s)", (name,))
-    db.commit()
-    db.close()
+    with session() as t:
+        return t.registerPlayers(names)
 
-def playerStandings():
+def playerStandings(tiebreaks=None):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a player
@@ -77,6 +707,14 @@ def playerStandings():
     has played stronger opponents will be placed higher, and for player that
     have received a bye to be placed lower if they have the same wins and OMW.
 
+    The standings are read from the standings table, which is updated as
+    results are reported, see rebuildStandings().
+
+    Args:
+      tiebreaks: optional chain of tiebreaks to sort players with the same
+        wins on instead, e.g. ('median', 'buchholz', 'sb'). The tiebreaks are
+        computed from the reported matches, see tiebreaks.compute().
+
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
         id: the player's unique id (assigned by the database)
@@ -85,12 +723,22 @@ def playerStandings():
         matches: the number of matches the player has played
         OMW: the number of matches won by opponents of the player
     """
-    db = connect()
-    c = db.cursor()
-    c.execute('select * from playerStandings;') # see view in tournament.sql
-    standings = c.fetchall()
-    db.close()
-    return standings
+    with session() as t:
+        return t.playerStandings(tiebreaks)
+
+def rebuildStandings():
+    """Checks the standings table against the match history and repairs it.
+
+    The standings table is kept up to date by triggers when matches and byes
+    are reported. This compares it with the standings computed from scratch by
+    the views in tournament.sql and rebuilds it if they differ.
+
+    Returns:
+      A list with the ids of the players whose standings were wrong, empty if
+      the standings table was consistent.
+    """
+    with session() as t:
+        return t.rebuildStandings()
 
 def reportMatch(player1, player2, win = None):
     """Records the outcome of a single match between two players.
@@ -102,11 +750,25 @@ def reportMatch(player1, player2, win = None):
         is provided)
 
     """
-    db = connect()
-    c = db.cursor()
-    c.execute("insert into matches (p1, p2, win) values (%s, %s, %s);", (player1, player2, win))
-    db.commit()
-    db.close()
+    with session() as t:
+        t.reportMatch(player1, player2, win)
+
+def reportMatches(matches):
+    """Records the outcome of many matches, e.g. a whole round, at once.
+
+    The matches are written in one transaction with multi-row inserts, the
+    same checks apply as for reportMatch().
+
+    Args:
+      matches: iterable of (player1, player2, win) tuples, see reportMatch().
+        A (player1, player2) tuple is recorded as a draw.
+
+    Raises:
+      BatchError: a match was refused, its position in matches is in the
+        index attribute. None of the matches are recorded.
+    """
+    with session() as t:
+        t.reportMatches(matches)
 
 def reportBye(playerid):
     """Recors a bye for a player in matches.
@@ -114,32 +776,112 @@ def reportBye(playerid):
     Args:
         playerid: the id number of the player receiving the bye
     """
-    db = connect()
-    c = db.cursor()
-    c.execute("insert into byes (id) values (%s);", (playerid, ))
-    db.commit()
-    db.close()
+    with session() as t:
+        t.reportBye(playerid)
+
+def reportByes(playerids):
+    """Records a bye for each of the players in one transaction.
+
+    Args:
+        playerids: iterable with the id numbers of the players
+
+    Raises:
+      BatchError: a bye was refused, none of the byes are recorded.
+    """
+    with session() as t:
+        t.reportByes(playerids)
 
 def playedMatchups():
     """ All played matchups up to that point in the competition.
     """
-    db = connect()
-    c = db.cursor()
-    c.execute("select * from playedMatchups;")
-    matchups = c.fetchall()
-    db.close()
-    return matchups
+    with session() as t:
+        return t.playedMatchups()
+
+def iterStandings(itersize=None):
+    """Yields the rows of playerStandings() one at a time.
+
+    The rows are read from a server-side cursor, itersize rows per round trip
+    (default ITERSIZE), so the standings of a large event are never held in
+    memory at once. The session stays open until the generator is exhausted or
+    closed.
+    """
+    with session() as t:
+        for row in t.iterStandings(itersize):
+            yield row
+
+def iterPlayedMatchups(itersize=None):
+    """Yields the rows of playedMatchups() one at a time, see iterStandings().
+    """
+    with session() as t:
+        for row in t.iterPlayedMatchups(itersize):
+            yield row
+
+def iterMatches(itersize=None):
+    """Yields the reported matches as (p1, p2, win) tuples, see iterStandings().
+
+    win is None for a draw.
+    """
+    with session() as t:
+        for row in t.iterMatches(itersize):
+            yield row
+
+def exportRows(out, columns, rows, format):
+    """Writes rows to the file out as CSV with a header or as NDJSON."""
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+    elif format == 'ndjson':
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row))) + '\n')
+    else:
+        raise ValueError("unknown export format %r" % (format,))
+
+def exportStandings(out, format='csv', itersize=None):
+    """Writes the standings to the file out in constant memory.
+
+    Args:
+      out: file object to write to.
+      format: 'csv' for comma separated values with a header row, 'ndjson'
+        for one JSON object per line. The columns are STANDINGS_COLUMNS.
+      itersize: rows read per round trip, see iterStandings().
+    """
+    exportRows(out, STANDINGS_COLUMNS, iterStandings(itersize), format)
+
+def exportMatches(out, format='csv', itersize=None):
+    """Writes the match history to the file out in constant memory.
+
+    The columns are MATCH_COLUMNS, see exportStandings().
+    """
+    exportRows(out, MATCH_COLUMNS, iterMatches(itersize), format)
 
 def assignedByes():
     """ Return all players that have received a bye
     """
-    db = connect()
-    c = db.cursor()
-    c.execute("select * from byes;")
-    byes = c.fetchall()
-    return byes
+    with session() as t:
+        return t.assignedByes()
 
-def swissPairings():
+def pairingSnapshot():
+    """Returns everything needed to pair the next round, read in one query.
+
+    The opponents and byes are kept between calls with the version of the
+    tournament they were read at. As long as the tournament is only changed
+    through sessions of this process, later calls only read the standings
+    and the new matches and byes are added to the kept opponents and byes.
+    They are shared between calls and must not be changed.
+
+    Returns:
+      A tuple (standings, opponents, byes):
+        standings: the rows of playerStandings()
+        opponents: dict mapping every player id to the set of ids of the
+          players they have played, see pairing.opponentIndex()
+        byes: ids of the players who have received a bye
+    """
+    with session() as t:
+        return t.pairingSnapshot()
+
+def swissPairings(strategy='random'):
     """Returns a list of pairs of players for the next round of a match.
 
     Assuming that there are an even number of players registered, each player
@@ -157,6 +899,18 @@ def swissPairings():
     Both are conditional on the fact that they have not played against the
     oppnent before.
 
+    This can run into a dead end late in a tournament, when the remaining
+    players have all played each other. The 'backtrack' strategy pairs each
+    player with the closest unplayed opponent in the standings that still
+    leaves a complete pairing for the others instead, see
+    pairing.backtrackPairings().
+
+    The standings and match history are read with a single query, see
+    pairingSnapshot(), and the bye is recorded in the same transaction.
+
+    Args:
+      strategy: 'random' (default) or 'backtrack'.
+
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
@@ -164,51 +918,5 @@ def swissPairings():
         id2: the second player's unique id
         name2: the second player's name
     """
-    standings = playerStandings()
-    playedmatchups = playedMatchups()
-    byes = [row[0] for row in assignedByes()]
-
-    # handle byes
-    if len(standings) % 2 != 0: # uneven players
-        # if first round assign bye at random
-        if standings[0][5] == 0:
-            bye = random.choice(standings)
-        else:
-        # assign bye to lowest standing player who has not received one before.
-            rev_stands = list(reversed(standings))
-            bye = next(row for row in rev_stands if row[0] not in byes)
-
-        # give bye and remove player from standing so he won't get paired
-        reportBye(bye[0])
-        index_bye = [row[0] for row in standings].index(bye[0])
-        del(standings[index_bye])
-
-    # handle matchups
-    matchups = []
-    while len(standings) > 1:
-        # pop player from standings, don't consider him for later pairings
-        player = standings.pop(-1)
-        playerID = player[0]
-        playerWins = player[2]
-
-        # player already played against, opponents that match wins of players,
-        # and check if player played opponent
-        played = [row[1] for row in playedmatchups if row[0] == playerID]
-        opponents = [row[0] for row in standings if row[2] == playerWins]
-        possibilities = [opp for opp in opponents if opp not in played]
-
-        # if no opponents with same wins, check players with 1 more win
-        if len(opponents) == 0:
-            opponents = [row[0] for row in standings if row[2] == (playerWins + 1)]
-            possibilities = [opp for opp in opponents if opp not in played]
-
-        opponent = random.choice(possibilities)
-
-        # find opponent's standings, add match to matchups
-        index_opp = [row[0] for row in standings].index(opponent)
-        match = (playerID, player[1], opponent, standings[index_opp][1])
-        matchups.append(match)
-
-        # remove opponent from standings table so they won't be paired again.
-        del(standings[index_opp])
-    return matchups
+    with session() as t:
+        return t.swissPairings(strategy)
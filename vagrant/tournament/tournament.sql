@@ -9,88 +9,316 @@
 create database tournament;
 \c tournament;
 
+-- Every event is a tournament, players, matches and byes belong to one.
+-- Matches and byes are partitioned by tournament: each tournament gets its own
+-- matches_<id> and byes_<id> tables, created by create_tournament() below and
+-- inheriting from the matches and byes tables. Queries on one tournament only
+-- touch its own tables and dropping a tournament drops its tables.
+-- version counts the statements that changed the matches or byes of a
+-- tournament, a reader can tell its copy of them is up to date by it.
+create table tournaments (
+  id serial primary key,
+  name text,
+  archived boolean not null default false,
+  version bigint not null default 0
+);
+
 -- Contains all players and gives them an ID.
 create table players (
   id serial primary key,
-  name text
+  tournament_id integer not null references tournaments(id),
+  name text,
+  unique (tournament_id, id)
 );
 
 -- Table containing all matches, match ID as players can face off in different
 -- matches against eachother, players need to be in players table.
 -- win is player id if someone won, or null for draw.
-
+-- The rows are in the partitions of the tournaments, the keys, indexes and
+-- references are created per partition in create_tournament().
 create table matches (
-  p1 integer references players(id),
-  p2 integer references players(id),
-  win integer references players(id),
+  tournament_id integer not null,
+  p1 integer not null,
+  p2 integer not null,
+  win integer,
   check ( (win = p1) or (win = p2) or (win is null) ),
-  check (p1 <> p2),
-  primary key (p1, p2)
+  check (p1 <> p2)
 );
--- make sure no duplicated matches are added.
-create unique index matchup on matches
-  (greatest(p1, p2), least(p1, p2));
 
 -- a bye is given to one person each round if there is an uneven number of
 -- players. This counts as a won match for the player against no opponent.
--- id as primary key ensures on DB level that no player receives 2 byes.
 create table byes (
-  id integer references players(id)
+  tournament_id integer not null,
+  id integer not null
+);
+
+-- Both directions of every match, (id, opponent) and (opponent, id), so that
+-- the opponents of a player and whether two players have met are primary key
+-- lookups. Kept up to date by the standings trigger on the matches
+-- partitions.
+create table opponents (
+  tournament_id integer not null,
+  id integer not null,
+  opponent integer not null,
+  draw integer
+);
+
+-- rows inserted in matches or byes are moved to the partition of their
+-- tournament.
+create function partition_insert() returns trigger as $$
+begin
+  execute format('insert into %I select ($1).*',
+                 tg_table_name || '_' || new.tournament_id)
+    using new;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger matches_partition before insert on matches
+  for each row execute procedure partition_insert();
+
+create trigger byes_partition before insert on byes
+  for each row execute procedure partition_insert();
+
+-- Standings of every player, kept up to date by the triggers below so reading
+-- the standings does not depend on the size of the match history.
+-- wins only counts won matches as OMW only counts those, byes are kept apart.
+create table standings (
+  id integer primary key references players(id) on delete cascade,
+  wins integer not null default 0,
+  losses integer not null default 0,
+  draws integer not null default 0,
+  byes integer not null default 0,
+  omw integer not null default 0,
+  tournament_id integer not null
 );
+-- the standings of a tournament and its players with a given score, for the
+-- validmatchups views.
+create index standings_score on standings (tournament_id, (wins + byes));
+
+-- every registered player starts with empty standings.
+create function standings_player() returns trigger as $$
+begin
+  insert into standings (id, tournament_id) values (new.id, new.tournament_id);
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger standings_player after insert on players
+  for each row execute procedure standings_player();
+
+-- add (insert) or take out (delete) a match from the standings and both its
+-- directions from the opponents partition of the tournament. A won match adds
+-- the wins of the loser to the OMW of the winner, the wins of the winner to
+-- the OMW of the loser and one to the OMW of every other opponent the winner
+-- has a match against that was not a draw.
+-- The opponents partition is only changed here, after the standings, so it
+-- holds exactly the matches already counted in the standings. A statement
+-- reporting many matches at once can not count a match twice: the winner's
+-- other opponents are looked up there and not in the matches partition,
+-- which already holds every row of the statement.
+create function standings_match() returns trigger as $$
+declare
+  m matches%rowtype;
+  s integer;
+  loser integer;
+  winnerwins integer;
+  loserwins integer;
+begin
+  if tg_op = 'INSERT' then
+    m := new;
+    s := 1;
+  else
+    m := old;
+    s := -1;
+  end if;
+
+  if m.win is null then
+    update standings set draws = draws + s where id in (m.p1, m.p2);
+  else
+    loser := case when m.win = m.p1 then m.p2 else m.p1 end;
+    -- wins of both players not counting this match
+    select wins + (s - 1) / 2 into winnerwins from standings where id = m.win;
+    select wins into loserwins from standings where id = loser;
+
+    update standings set wins = wins + s, omw = omw + s * loserwins
+      where id = m.win;
+    update standings set losses = losses + s, omw = omw + s * (winnerwins + 1)
+      where id = loser;
+    execute format('update standings set omw = omw + $1
+                     where id in
+                      (select opponent from %I
+                        where id = $2 and opponent <> $3 and draw is null)',
+                   'opponents_' || m.tournament_id)
+      using s, m.win, loser;
+  end if;
+
+  if tg_op = 'INSERT' then
+    execute format('insert into %I values
+                      ($1, $2, $3, $4), ($1, $3, $2, $4)',
+                   'opponents_' || m.tournament_id)
+      using m.tournament_id, m.p1, m.p2,
+        case when m.win is null then 1 end;
+  else
+    execute format('delete from %I
+                     where (id, opponent) in (($1, $2), ($2, $1))',
+                   'opponents_' || m.tournament_id)
+      using m.p1, m.p2;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create function standings_bye() returns trigger as $$
+begin
+  if tg_op = 'INSERT' then
+    update standings set byes = byes + 1 where id = new.id;
+  else
+    update standings set byes = byes - 1 where id = old.id;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+-- bump the version of the tournament given as argument, runs once per
+-- statement on the matches and byes partitions.
+create function tournament_version() returns trigger as $$
+begin
+  update tournaments set version = version + 1 where id = tg_argv[0]::integer;
+  return null;
+end;
+$$ language plpgsql;
+
+-- Create a tournament with its matches and byes partitions, returns its id.
+create function create_tournament(tname text) returns integer as $$
+declare
+  tid integer;
+begin
+  insert into tournaments (name) values (tname) returning id into tid;
+
+  execute format('create table matches_%s (
+                    check (tournament_id = %s),
+                    primary key (p1, p2),
+                    foreign key (tournament_id, p1) references players (tournament_id, id),
+                    foreign key (tournament_id, p2) references players (tournament_id, id),
+                    foreign key (tournament_id, win) references players (tournament_id, id)
+                  ) inherits (matches)', tid, tid);
+  -- make sure no duplicated matches are added.
+  execute format('create unique index matchup_%s on matches_%s
+                    (greatest(p1, p2), least(p1, p2))', tid, tid);
+  -- p1 is covered by the primary key, p2 is needed to find the match of a
+  -- player as second player.
+  execute format('create index matches_p2_%s on matches_%s (p2)', tid, tid);
+
+  execute format('create table opponents_%s (
+                    check (tournament_id = %s),
+                    primary key (id, opponent)
+                  ) inherits (opponents)', tid, tid);
+  execute format('create trigger standings_match
+                    after insert or delete on matches_%s
+                    for each row execute procedure standings_match()', tid);
+
+  execute format('create table byes_%s (
+                    check (tournament_id = %s),
+                    foreign key (tournament_id, id) references players (tournament_id, id)
+                  ) inherits (byes)', tid, tid);
+  execute format('create index byes_id_%s on byes_%s (id)', tid, tid);
+  execute format('create trigger standings_bye
+                    after insert or delete on byes_%s
+                    for each row execute procedure standings_bye()', tid);
+
+  execute format('create trigger matches_version
+                    after insert or update or delete or truncate on matches_%s
+                    for each statement execute procedure tournament_version(%s)',
+                 tid, tid);
+  execute format('create trigger byes_version
+                    after insert or update or delete or truncate on byes_%s
+                    for each statement execute procedure tournament_version(%s)',
+                 tid, tid);
+  return tid;
+end;
+$$ language plpgsql;
+
+-- Drop a tournament, its partitions and its players.
+create function drop_tournament(tid integer) returns void as $$
+begin
+  execute format('drop table if exists matches_%s, opponents_%s, byes_%s',
+                 tid, tid, tid);
+  delete from players where tournament_id = tid;
+  delete from tournaments where id = tid;
+end;
+$$ language plpgsql;
+
+-- Archive a tournament: its partitions are detached from matches and byes and
+-- kept as plain tables, the players and standings stay.
+create function archive_tournament(tid integer) returns void as $$
+begin
+  execute format('alter table matches_%s no inherit matches', tid);
+  execute format('alter table opponents_%s no inherit opponents', tid);
+  execute format('alter table byes_%s no inherit byes', tid);
+  update tournaments set archived = true where id = tid;
+end;
+$$ language plpgsql;
 
 -- view to get all wins and losses of a player, this is used as subset for
 -- playerstandings stats and OMW and draws.
 create view playersMatchstats as
   select id,
-    coalesce(winl, 0) + coalesce(winr, 0) as wins,
-    coalesce(lossl, 0) + coalesce(lossr, 0) as losses,
-    coalesce(drawl, 0) + coalesce(drawr, 0) as draws
+    sum(case when id = win then 1 else 0 end) as wins,
+    sum(case when id <> win then 1 else 0 end) as losses,
+    sum(case when win is null then 1 else 0 end) as draws,
+    tournament_id
    from
-    (select p1 as id,
-      sum(case when p1 = win then 1 else 0 end) as winl,
-      sum(case when p2 = win then 1 else 0 end) as lossl,
-      sum(case when win is null then 1 else 0 end) as drawl
-      from matches group by p1) a
-    full join
-    (select p2 as id,
-      sum(case when p2 = win then 1 else 0 end) as winr,
-      sum(case when p1 = win then 1 else 0 end) as lossr,
-      sum(case when win is null then 1 else 0 end) as drawr
-      from matches group by p2) b
-    using (id);
+    (select tournament_id, p1 as id, win from matches
+     union all
+     select tournament_id, p2 as id, win from matches) as a
+   group by tournament_id, id;
 
 
 -- view to show all played matchups in the tournament per player.
 -- as byes count as a match, but there was no matchup, ignore byes.
+-- read from the opponents table, which has both directions of every match.
 create view playedMatchups as
-  select * from
-    (select p1 as id,
-      p2 as opponent,
-      case when win is null then 1 end as draw
-    from matches) as a
-  full join
-    (select p2 as id,
-      p1 as opponent,
-      case when win is null then 1 end as draw
-    from matches) as b
-  using (id, opponent, draw)
-  order by id;
-
--- Opponents Win Matches (OMW) calculation, using playerMatchStats and
--- playedMatchups. Only dependent on matches, should not take into account byes.
-create view OMW as
+  select id,
+    opponent,
+    draw,
+    tournament_id
+  from opponents;
+
+-- Opponents Win Matches (OMW) calculation, using playersMatchstats and both
+-- directions of every match read straight from matches. Only dependent on
+-- matches, should not take into account byes. Computes the wins of every
+-- player of the tournament, it is used to check the standings and opponents
+-- tables, so it does not read them.
+create view computedOMW as
   select player as id,
-    sum(wins) as OMW
+    sum(wins) as OMW,
+    tournament_id
    from
-   (select id as player,
-     opponent as id
-  from playedMatchups where draw is null) as a
+   (select tournament_id, p1 as player, p2 as id from matches
+     where win is not null
+    union all
+    select tournament_id, p2 as player, p1 as id from matches
+     where win is not null) as a
   left join
    (select id,
      wins
   from playersMatchstats) as b
   using (id)
-  group by player;
+  group by tournament_id, player;
+
+-- Opponents Win Matches (OMW) from the opponents and standings tables: the
+-- OMW of a player is a lookup of their opponents and of the standings of
+-- each of them, instead of counting the wins of every player.
+create view OMW as
+  select o.id,
+    sum(s.wins) as OMW,
+    o.tournament_id
+  from opponents as o
+   join standings as s
+   on s.id = o.opponent
+  where o.draw is null
+  group by o.tournament_id, o.id;
 
   -- View to create a player standings ordered by wins, matchcount (for byes).
   -- Uses matches table and byes table to determine standings
@@ -101,48 +329,124 @@ create view OMW as
      coalesce(losses, 0) as losses,
      coalesce(draws, 0) as draws,
      coalesce(wins, 0) + coalesce(losses, 0) + coalesce (draws, 0 ) as matchcount,
-     coalesce(OMW, 0) as OMW
+     coalesce(OMW, 0) as OMW,
+     p.tournament_id
     from
-      ((playersMatchstats as a
-    full join
+     players as p
+    left join
+     (select id,
+       wins,
+       losses,
+       draws
+     from playersMatchstats) as a
+    using (id)
+    left join
       (select id,
         count(id) as byes
       from byes
       group by id) as b
-    using(id)) as ab
-    full join
-      OMW as c
-    using (id)) as abc
-    right join
-    players as p
+    using (id)
+    left join
+     (select id,
+       OMW
+     from computedOMW) as c
     using (id)
   order by wins desc, OMW desc, matchcount desc;
 
+-- player standings read from the standings table, same columns and order as
+-- the playerStandings view.
+create view currentStandings as
+  select p.id,
+    p.name,
+    s.wins + s.byes as wins,
+    s.losses,
+    s.draws,
+    s.wins + s.losses + s.draws as matchcount,
+    s.omw,
+    s.tournament_id
+  from standings as s
+   join players as p
+   using (id)
+  order by wins desc, omw desc, matchcount desc, id;
+
 -- contains all valid matchups for that point of the tournament: players with
 -- equal wins are paired, but not matchups that have already been played.
+-- The players with the same score are found with the standings_score index,
+-- which needs b.wins + b.byes on its own on one side.
 create view validmatchupsequalwin as
   select a.id as p1,
-    b.id as p2
+    b.id as p2,
+    a.tournament_id
   from
-    playerStandings as a
-   full join
-    playerStandings as b
-   on a.wins = b.wins
+    standings as a
+   join
+    standings as b
+   on b.wins + b.byes = a.wins + a.byes
+    and b.tournament_id = a.tournament_id
   where a.id <> b.id
-   and (a.id, b.id) not in (select id, opponent from playedMatchups)
-  order by p1;
+   and not exists (select 1 from opponents as o
+                    where o.tournament_id = a.tournament_id
+                     and o.id = a.id and o.opponent = b.id);
 
 -- contains all valid matchups for that part of the tournament: players with
 -- one win or loss difference are paired, already played matchups are filtered
 -- out.
 create view validmatchupsonediffwin as
   select a.id as p1,
-    b.id as p2
+    b.id as p2,
+    a.tournament_id
   from
-    playerStandings as a
-   full join
-    playerStandings as b
-   on (a.wins = b.wins + 1) or (a.wins = b.wins - 1)
+    standings as a
+   join
+    standings as b
+   on b.wins + b.byes in (a.wins + a.byes - 1, a.wins + a.byes + 1)
+    and b.tournament_id = a.tournament_id
   where a.id <> b.id
-   and (a.id, b.id) not in (select id, opponent from playedMatchups)
-  order by p1;
+   and not exists (select 1 from opponents as o
+                    where o.tournament_id = a.tournament_id
+                     and o.id = a.id and o.opponent = b.id);
+
+-- what the standings table should contain, computed from scratch with the
+-- views above. Used to check and rebuild the standings table.
+create view computedStandings as
+  select p.id,
+    coalesce(a.wins, 0)::integer as wins,
+    coalesce(a.losses, 0)::integer as losses,
+    coalesce(a.draws, 0)::integer as draws,
+    (select count(*) from byes as b
+      where b.tournament_id = p.tournament_id and b.id = p.id)::integer as byes,
+    coalesce(c.OMW, 0)::integer as omw,
+    p.tournament_id
+  from players as p
+   left join playersMatchstats as a
+   using (id)
+   left join computedOMW as c
+   using (id);
+
+-- everything swissPairings needs for a round in one query: the standings
+-- with whether the player had a bye and the ids of all their opponents.
+create view pairingSnapshot as
+  select p.id,
+    p.name,
+    s.wins + s.byes as wins,
+    s.losses,
+    s.draws,
+    s.wins + s.losses + s.draws as matchcount,
+    s.omw,
+    s.byes > 0 as hadbye,
+    coalesce(o.opponents, '{}') as opponents,
+    s.tournament_id
+  from standings as s
+   join players as p
+   using (id)
+   left join
+    (select tournament_id,
+       id,
+       array_agg(opponent) as opponents
+     from opponents
+     group by tournament_id, id) as o
+   on o.tournament_id = s.tournament_id and o.id = s.id
+  order by wins desc, omw desc, matchcount desc, id;
+
+-- the tournament used by the module level functions of tournament.py.
+select create_tournament('default');
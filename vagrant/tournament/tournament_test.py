@@ -7,7 +7,20 @@
 # as appropriate to account for your module's added functionality.
 
 from tournament import *
+import csv
+import instrument
 import itertools
+import json
+import memory
+import pairing
+import psycopg2.pool
+import random
+import simulate
+import StringIO
+import sys
+import tiebreaks
+import time
+import tournament
 
 def testFirstRound():
     '''
@@ -246,10 +259,571 @@ def testPairings():
     #             "After one match, players with one win should be paired.")
     print "10. After one match, players are properly paired."
 
+def testSession():
+    """
+    Test that a Tournament session shares one transaction between calls and
+    rolls it back when the block raises.
+    """
+    deleteMatches()
+    deletePlayers()
+    with Tournament() as t:
+        id1 = t.registerPlayer("Twilight Sparkle")
+        id2 = t.registerPlayer("Fluttershy")
+        t.reportMatch(id1, id2, id1)
+        if t.countPlayers() != 2:
+            raise ValueError("A session should see its own uncommitted players.")
+    if countPlayers() != 2:
+        raise ValueError("Leaving a session should commit its transaction.")
+    try:
+        with Tournament() as t:
+            t.registerPlayer("Applejack")
+            raise KeyError("abort")
+    except KeyError:
+        pass
+    if countPlayers() != 2:
+        raise ValueError("A session that raised should be rolled back.")
+    # connections of connect() are closed by the caller, not pooled
+    for n in range(tournament.POOL_MAX + 1):
+        db = connect()
+        db.close()
+    if connectionsInUse() != 0 or countPlayers() != 2:
+        raise ValueError("Closing a connection of connect() should not hold a pool slot.")
+    print "11. Sessions commit on exit and roll back on errors."
+
+def testBulkReport():
+    """
+    Test that players, matches and byes can be reported in bulk and that a
+    refused row is reported with its position while nothing is written.
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4, id5] = registerPlayers(["Bruno Walton", "Boots O'Neal",
+                                                 "Cathy Burton", "Diane Grant",
+                                                 "Lucy Himmel"])
+    if countPlayers() != 5:
+        raise ValueError("registerPlayers should register every player.")
+    reportMatches([(id1, id2, id1), (id3, id4)])
+    reportByes([id5])
+    standings = dict((row[0], row) for row in playerStandings())
+    if standings[id1][2] != 1 or standings[id2][3] != 1:
+        raise ValueError("reportMatches should record wins and losses.")
+    if standings[id3][4] != 1 or standings[id4][4] != 1:
+        raise ValueError("A match without winner should be recorded as a draw.")
+    if standings[id5][2] != 1:
+        raise ValueError("reportByes should count a bye as a win.")
+    try:
+        reportMatches([(id1, id3, id1), (id2, id1, id2), (id4, id5, id5)])
+    except BatchError as e:
+        if e.index != 1:
+            raise ValueError(
+                "The rematch should be reported as row 1, got {}".format(e.index))
+    else:
+        raise ValueError("reportMatches should refuse a rematch.")
+    if len(playedMatchups()) != 4:
+        raise ValueError("A refused batch should not record any of its matches.")
+    print "12. Bulk reports are recorded and refused rows are pointed out."
+
+def testStandingsTable():
+    """
+    Test that the standings table follows reported results, agrees with the
+    playerStandings view and is repaired by rebuildStandings().
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4, id5] = registerPlayers(["Twilight Sparkle", "Fluttershy",
+                                                 "Applejack", "Pinkie Pie",
+                                                 "Rarity"])
+    # the winner of the first match loses the second in the same statement
+    reportMatches([(id1, id2, id1), (id3, id1, id3), (id4, id1, id4)])
+    omw = dict((row[0], row[6]) for row in playerStandings())
+    if omw[id3] != 1 or omw[id4] != 1 or omw[id1] != 2:
+        raise ValueError(
+            "A batch should count every match once in the OMW, got {}".format(omw))
+    if rebuildStandings() != []:
+        raise ValueError("A batch with a player in several matches should keep the standings consistent.")
+    deleteMatches()
+    reportMatches([(id1, id2, id1), (id3, id4, id3)])
+    reportBye(id5)
+    reportMatches([(id1, id3, id3), (id2, id4), (id5, id2, id5)])
+    with Tournament() as t:
+        t.c.execute("""select id, name, wins, losses, draws, matchcount, OMW
+                        from playerStandings where tournament_id = %s;""",
+                    (t.tournament_id,))
+        expected = set(t.c.fetchall())
+    if set(playerStandings()) != expected:
+        raise ValueError("The standings table should agree with the playerStandings view.")
+    if rebuildStandings() != []:
+        raise ValueError("rebuildStandings should find consistent standings.")
+    with Tournament() as t:
+        t.c.execute("update standings set omw = 99 where id = %s;", (id4,))
+    if rebuildStandings() != [id4]:
+        raise ValueError("rebuildStandings should point out the wrong standings.")
+    if set(playerStandings()) != expected:
+        raise ValueError("rebuildStandings should repair the standings table.")
+    # the trigger misses the win of id3 for id1 when the opponents table
+    # drifted, the check reads the matches and finds it
+    with Tournament() as t:
+        t.c.execute("delete from %s where (id, opponent) in ((%%s, %%s), (%%s, %%s));"
+                    % t.partition('opponents'), (id1, id3, id3, id1))
+    reportMatch(id3, id5, id3)
+    if rebuildStandings() != [id1]:
+        raise ValueError("rebuildStandings should not trust the opponents table.")
+    print "13. The standings table is kept up to date and can be rebuilt."
+
+def testPairingEngine():
+    """
+    Test the pairing engine without the database on a large field: everybody
+    is paired once, with the same or one more win and without rematches.
+    """
+    players = 2000
+    standings = [(i, "Pony %d" % i, 3 - i * 4 // players, 0, 0, 3, 0)
+                 for i in range(players)]
+    played = [(i, i ^ 1) for i in range(players)]
+    opponents = pairing.opponentIndex(played)
+    wins = dict((row[0], row[2]) for row in standings)
+    # the random pairer can run into a dead end, seed it to pair the same
+    # round every run
+    pairings = pairing.randomPairings(standings, opponents, random.Random(0))
+    paired = [row[0] for row in pairings] + [row[2] for row in pairings]
+    if sorted(paired) != range(players):
+        raise ValueError("Every player should be paired exactly once.")
+    for (id1, name1, id2, name2) in pairings:
+        if id2 in opponents.get(id1, ()):
+            raise ValueError("Players should not be paired for a rematch.")
+        if wins[id2] - wins[id1] not in (0, 1):
+            raise ValueError("Players should be paired with the same or one more win.")
+    print "14. The pairing engine pairs a large field by the pairing rules."
+
+def testBacktrackPairings():
+    """
+    Test that the backtracking pairer gets out of a dead end and reports a
+    round that can not be paired, both without searching for long.
+    """
+    standings = [(i, "Pony %d" % i, 3 - i, 0, 0, 3, 0) for i in range(4)]
+    # pairing 0-1 leaves 2 and 3, who have played each other already
+    opponents = pairing.opponentIndex([(2, 3), (3, 2)])
+    pairings = pairing.backtrackPairings(standings, opponents)
+    if [(row[0], row[2]) for row in pairings] != [(0, 2), (1, 3)]:
+        raise ValueError(
+            "The pairer should backtrack out of a dead end, got {}".format(pairings))
+    # 3 has played everybody
+    opponents = pairing.opponentIndex([(3, 0), (3, 1), (3, 2), (0, 3), (1, 3), (2, 3)])
+    try:
+        pairing.backtrackPairings(standings, opponents)
+    except pairing.PairingError:
+        pass
+    else:
+        raise ValueError("A round that can not be paired should raise PairingError.")
+    # the bottom player has played everybody but the leader
+    players = 24
+    standings = [(i, "Pony %d" % i, players - i, 0, 0, 3, 0) for i in range(players)]
+    last = players - 1
+    opponents = pairing.opponentIndex([(last, i) for i in range(1, last)] +
+                                      [(i, last) for i in range(1, last)])
+    start = time.time()
+    pairings = pairing.backtrackPairings(standings, opponents)
+    if time.time() - start > 1:
+        raise ValueError("Pairing 24 players should take well under a second.")
+    if (0, last) not in [(row[0], row[2]) for row in pairings]:
+        raise ValueError("The bottom player should be paired with the leader.")
+    # one player has played everybody
+    players = 22
+    standings = standings[:players]
+    opponents = pairing.opponentIndex([(11, i) for i in range(players) if i != 11] +
+                                      [(i, 11) for i in range(players) if i != 11])
+    start = time.time()
+    try:
+        pairing.backtrackPairings(standings, opponents)
+    except pairing.PairingError:
+        pass
+    else:
+        raise ValueError("A round that can not be paired should raise PairingError.")
+    if time.time() - start > 1:
+        raise ValueError("A round that can not be paired should be reported at once.")
+    print "15. The backtracking pairer never runs into a dead end."
+
+def testSimulate():
+    """
+    Test that the simulator plays the same tournaments for the same seed and
+    sorts the final standings on the tiebreaks it is given.
+    """
+    task = (7, 20, 8, 3, 'backtrack', 200, 0.05, ('median', 'buchholz', 'sb'))
+    counts = simulate.playEvents(task)
+    if (counts.sum(axis=0) != 20).any() or (counts.sum(axis=1) != 20).any():
+        raise ValueError("Every seed should finish in one place per tournament.")
+    if (simulate.playEvents(task) != counts).any():
+        raise ValueError("The same seed should give the same results.")
+    try:
+        simulate.playEvents(task[:-1] + (('unknown',),))
+    except ValueError:
+        pass
+    else:
+        raise ValueError("The tiebreaks should be passed to playerStandings().")
+    if simulate.parseTiebreaks('median, buchholz,sb') != task[-1]:
+        raise ValueError("--tiebreaks should take a comma separated chain.")
+    counts = simulate.simulate(8, 3, 20, processes=2, chunk=5, seed=1,
+                               chain=('omwp',))
+    if (simulate.simulate(8, 3, 20, processes=2, chunk=5, seed=1,
+                          chain=('omwp',)) != counts).any():
+        raise ValueError("The pool should give the same results for the same seed.")
+    print "25. The simulator is repeatable and sorts on the given tiebreaks."
+
+def testPairingSnapshot():
+    """
+    Test that the pairing snapshot agrees with the standings, the played
+    matchups and the byes.
+    """
+    testFirstRoundUneven()
+    standings, opponents, byes = pairingSnapshot()
+    if standings != playerStandings():
+        raise ValueError("The snapshot should contain the player standings.")
+    played = dict((i, opps) for (i, opps) in opponents.items() if opps)
+    if played != pairing.opponentIndex(playedMatchups()):
+        raise ValueError("The snapshot should contain the opponents of every player.")
+    if byes != [row[0] for row in assignedByes()]:
+        raise ValueError("The snapshot should contain the players that had a bye.")
+    print "16. The pairing snapshot holds the standings, opponents and byes."
+
+def testTournaments():
+    """
+    Test that tournaments keep their players and matches apart and can be
+    deleted as a whole.
+    """
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Twilight Sparkle", "Fluttershy"])
+    tid = createTournament("Equestria Games")
+    with Tournament(tid) as t:
+        [id1, id2, id3] = t.registerPlayers(["Applejack", "Pinkie Pie", "Rarity"])
+        t.reportMatch(id1, id2, id1)
+        t.reportBye(id3)
+        if t.countPlayers() != 3:
+            raise ValueError("A tournament should only count its own players.")
+        if len(t.playerStandings()) != 3 or len(t.playedMatchups()) != 2:
+            raise ValueError("A tournament should only show its own standings and matches.")
+    if countPlayers() != 2 or playedMatchups() or assignedByes():
+        raise ValueError("Other tournaments should not change the default tournament.")
+    deleteTournament(tid)
+    with Tournament() as t:
+        t.c.execute("select count(*) from players where tournament_id = %s;", (tid,))
+        if t.c.fetchone()[0] != 0:
+            raise ValueError("Deleting a tournament should delete its players.")
+    print "17. Tournaments are kept apart and deleted as a whole."
+
+def testMemoryFlush():
+    """
+    Test that the in-memory backend writes its tournament behind to the
+    database.
+    """
+    deleteMatches()
+    deletePlayers()
+    m = memory.MemoryTournament(persist=Tournament, flush='manual')
+    [id1, id2, id3, id4, id5] = m.registerPlayers(["Twilight Sparkle", "Fluttershy",
+                                                   "Applejack", "Pinkie Pie",
+                                                   "Rarity"])
+    m.reportMatches([(id1, id2, id1), (id3, id4)])
+    m.reportBye(id5)
+    if countPlayers() != 0:
+        raise ValueError("Nothing should be written before a flush.")
+    m.flush()
+    expected = [row[1:] for row in m.playerStandings()]
+    if sorted(row[1:] for row in playerStandings()) != sorted(expected):
+        raise ValueError("A flush should write the players, matches and byes.")
+    # a flush that fails is rolled back and tried again by the next flush
+    deleteMatches()
+    deletePlayers()
+    failures = [ValueError("Flush failure")]
+    class FailingTournament(Tournament):
+        def reportByes(self, playerids):
+            if failures:
+                raise failures.pop()
+            return Tournament.reportByes(self, playerids)
+    m = memory.MemoryTournament(persist=FailingTournament, flush='manual')
+    [id1, id2, id3] = m.registerPlayers(["Applejack", "Pinkie Pie", "Rarity"])
+    m.reportMatch(id1, id2, id1)
+    m.reportBye(id3)
+    try:
+        m.flush()
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A failed flush should raise its error.")
+    if countPlayers() != 0 or m.dbids:
+        raise ValueError("A failed flush should not leave players behind.")
+    m.flush()
+    expected = [row[1:] for row in m.playerStandings()]
+    if sorted(row[1:] for row in playerStandings()) != sorted(expected):
+        raise ValueError("The next flush should write what a failed flush did not.")
+    # the module level backend is written when it is replaced
+    deleteMatches()
+    deletePlayers()
+    setBackend('memory', persist=Tournament)
+    [id1, id2] = registerPlayers(["Applejack", "Rarity"])
+    reportMatch(id1, id2, id1)
+    setBackend('postgres')
+    if sorted(row[2] for row in playerStandings()) != [0, 1]:
+        raise ValueError("Replacing the backend should write what it did not write yet.")
+    print "18. The in-memory backend writes its tournament behind to the database."
+
+def testOpponentLookups():
+    """
+    Test that the opponents of a player and whether two players have met can
+    be looked up.
+    """
+    testFirstRound()
+    [id1, id2, id3] = [row[0] for row in playerStandings()][:3]
+    opponents = pairing.opponentIndex(playedMatchups())
+    if set(opponentsOf(id1)) != opponents[id1]:
+        raise ValueError("opponentsOf should return the opponents of a player.")
+    [opponent] = opponentsOf(id1)
+    if not havePlayed(id1, opponent) or not havePlayed(opponent, id1):
+        raise ValueError("havePlayed should find the players that have met.")
+    other = [i for i in (id2, id3) if i != opponent][0]
+    if havePlayed(id1, other):
+        raise ValueError("havePlayed should not find players that have not met.")
+    print "19. Opponents of a player and past matchups are looked up."
+
+def seqScans(plan):
+    """
+    Returns the tables a query plan scans sequentially, leaving out the parent
+    tables of the partitions which are always empty.
+    """
+    scans = []
+    if (plan['Node Type'] == 'Seq Scan' and
+            plan['Relation Name'] not in ('matches', 'opponents', 'byes')):
+        scans.append(plan['Relation Name'])
+    for subplan in plan.get('Plans', []):
+        scans.extend(seqScans(subplan))
+    return scans
+
+def testNoSeqScans():
+    """
+    Test that the opponents, OMW and valid matchup lookups of one player use
+    the indexes with 100k matches played.
+
+    The planner rightly scans small tables sequentially, so sequential scans
+    are turned off: one that is still in a plan means no index can serve the
+    query.
+    """
+    tid = createTournament("Sequential scan check")
+    try:
+        with Tournament(tid) as t:
+            ids = t.registerPlayers(["Pony %d" % i for i in range(20000)])
+            t.reportMatches([(ids[i], ids[i + r], ids[i])
+                             for r in range(1, 6) for i in range(len(ids) - r)])
+            t.c.execute("analyze;")
+            t.c.execute("set local enable_seqscan = off;")
+            opponents = t.partition('opponents')
+            queries = [
+                ("select opponent from %s where id = %%s;" % opponents,
+                 (ids[100],)),
+                ("select 1 from %s where id = %%s and opponent = %%s;" % opponents,
+                 (ids[100], ids[101])),
+                ("select opponent from playedMatchups where tournament_id = %s and id = %s;",
+                 (tid, ids[100])),
+                ("select OMW from OMW where tournament_id = %s and id = %s;",
+                 (tid, ids[100])),
+                ("select p2 from validmatchupsequalwin where tournament_id = %s and p1 = %s;",
+                 (tid, ids[100])),
+                ("select p2 from validmatchupsonediffwin where tournament_id = %s and p1 = %s;",
+                 (tid, ids[100]))]
+            for query, args in queries:
+                t.c.execute("explain (format json) " + query, args)
+                plan = t.c.fetchone()[0]
+                if isinstance(plan, basestring):
+                    plan = json.loads(plan)
+                scans = seqScans(plan[0]['Plan'])
+                if scans:
+                    raise ValueError(
+                        "{} should not scan {} sequentially".format(query, scans))
+    finally:
+        deleteTournament(tid)
+    print "20. Opponent, OMW and matchup lookups use indexes with 100k matches played."
+
+
+def testTiebreaks():
+    """
+    Test that playerStandings() sorts players with the same wins on a chain
+    of tiebreaks computed from the reported matches.
+    """
+    deleteMatches()
+    deletePlayers()
+    [a, b, c, d] = registerPlayers(["Twilight Sparkle", "Fluttershy",
+                                    "Applejack", "Pinkie Pie"])
+    reportMatches([(a, b, a), (c, d)])
+    reportMatches([(a, c, a), (b, d, b)])
+    reportMatches([(a, d), (b, c, b)])
+    if playerStandings(tiebreaks.DEFAULT_CHAIN) != playerStandings():
+        raise ValueError(
+            "The default tiebreak chain should sort like the standings table.")
+    # Buchholz: a 3.5, b 4, c 5.5, d 5. Sonneborn-Berger: a 3, b 1.5, c 0.5,
+    # d 1.5. Median-Buchholz: a 1, b 1, c 2, d 2.
+    for chain, expected in [(('buchholz',), [b, a, c, d]),
+                            (('sb',), [a, b, d, c]),
+                            (('median', 'sb'), [a, b, d, c])]:
+        order = [row[0] for row in playerStandings(chain)]
+        if order != expected:
+            raise ValueError("Tiebreaks {} should sort the players as {}, got {}"
+                             .format(chain, expected, order))
+    standings = playerStandings()
+    scores = tiebreaks.compute([row[0] for row in standings],
+                               [(a, b, a), (c, d, None), (a, c, a), (b, d, b),
+                                (a, d, None), (b, c, b)])
+    if list(scores['omw']) != [row[6] for row in standings]:
+        raise ValueError("The OMW tiebreak should match the OMW of the standings.")
+    print "21. Standings can be sorted on a chain of tiebreaks."
+
+
+def testStreaming():
+    """
+    Test that the iter functions yield the same rows as their list versions
+    and that standings and matches are exported as CSV and NDJSON.
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4] = registerPlayers(["Twilight Sparkle", "Fluttershy",
+                                            "Applejack", "Pinkie Pie"])
+    reportMatches([(id1, id2, id1), (id3, id4)])
+    if list(iterStandings(itersize=1)) != playerStandings():
+        raise ValueError("iterStandings should yield the rows of playerStandings.")
+    if sorted(iterPlayedMatchups(itersize=1)) != sorted(playedMatchups()):
+        raise ValueError(
+            "iterPlayedMatchups should yield the rows of playedMatchups.")
+    if sorted(iterMatches()) != sorted([(id1, id2, id1), (id3, id4, None)]):
+        raise ValueError("iterMatches should yield the reported matches.")
+    with session() as t:
+        # two streams open in the same session at the same time
+        pairs = list(itertools.izip(t.iterStandings(itersize=1),
+                                    t.iterPlayedMatchups(itersize=1)))
+    if len(pairs) != 4:
+        raise ValueError("Streams of one session should be read side by side.")
+    out = StringIO.StringIO()
+    exportStandings(out)
+    rows = list(csv.reader(StringIO.StringIO(out.getvalue())))
+    if rows[0] != list(STANDINGS_COLUMNS) or len(rows) != 5:
+        raise ValueError("exportStandings should write a header and a row per player.")
+    if [int(row[0]) for row in rows[1:]] != [row[0] for row in playerStandings()]:
+        raise ValueError("exportStandings should write the players in order.")
+    out = StringIO.StringIO()
+    exportMatches(out, 'ndjson')
+    matches = [json.loads(line) for line in out.getvalue().splitlines()]
+    if sorted((m['p1'], m['p2'], m['win']) for m in matches) != sorted(
+            [(id1, id2, id1), (id3, id4, None)]):
+        raise ValueError("exportMatches should write a JSON object per match.")
+    print "22. Standings and matches are streamed and exported."
+
+
+def testPairingCache():
+    """
+    Test that the pairing snapshot kept between rounds follows reported
+    results, is read again after changes it did not see and is dropped by
+    deleteMatches().
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4, id5] = registerPlayers(["Twilight Sparkle", "Fluttershy",
+                                                 "Applejack", "Pinkie Pie",
+                                                 "Rarity"])
+
+    def check(message):
+        standings, opponents, byes = pairingSnapshot()
+        expected = pairing.opponentIndex(playedMatchups())
+        if dict((k, v) for k, v in opponents.items() if v) != expected:
+            raise ValueError(message)
+        if set(byes) != set(row[0] for row in assignedByes()):
+            raise ValueError(message)
+        if standings != playerStandings():
+            raise ValueError(message)
+
+    check("The first snapshot should hold the opponents and byes.")
+    for n in range(2):
+        pairings = swissPairings('backtrack')
+        reportMatches([(row[0], row[2], row[0]) for row in pairings])
+        check("The kept snapshot should follow the reported results.")
+    with Tournament() as t:
+        t.c.execute("select version from tournaments where id = %s;",
+                    (t.tournament_id,))
+        if t.c.fetchone()[0] != tournament._pairingCache[t.tournament_id].version:
+            raise ValueError("The kept snapshot should be of the current version.")
+        # a change the kept snapshot does not know of
+        t.c.execute("delete from %s where p1 = %%s or p2 = %%s;" %
+                    t.partition('matches'), (id1, id1))
+    check("The snapshot should be read again after a change it did not see.")
+    deleteMatches()
+    if tournament.DEFAULT_TOURNAMENT in tournament._pairingCache:
+        raise ValueError("deleteMatches should drop the kept snapshot.")
+    check("The snapshot should be empty after deleting the matches.")
+    print "23. The pairing snapshot is kept between rounds."
+
+
+def testInstrumentation():
+    """
+    Test that instrumentation records the calls of the public functions per
+    round and puts the functions back when it is disabled.
+    """
+    deleteMatches()
+    deletePlayers()
+    original = tournament.registerPlayers
+    with instrument.recording() as stats:
+        ids = tournament.registerPlayers(["Twilight Sparkle", "Fluttershy",
+                                          "Applejack", "Pinkie Pie"])
+        for n in range(2):
+            pairings = tournament.swissPairings()
+            tournament.reportMatches([(row[0], row[2], row[0])
+                                      for row in pairings])
+        list(tournament.iterStandings())
+    if tournament.registerPlayers is not original:
+        raise ValueError("Disabling instrumentation should restore the functions.")
+    if len(stats.rounds) != 3:
+        raise ValueError("Every swissPairings call should start a new round.")
+    if stats.functions['reportMatches']['calls'] != 2:
+        raise ValueError("Every call should be recorded.")
+    if stats.rounds[1]['pairing.pairRound']['calls'] != 1:
+        raise ValueError("The pairing engine should be recorded per round.")
+    if tournament._backend is None:
+        with Tournament() as t:
+            try:
+                instrument.enable()
+            except psycopg2.pool.PoolError:
+                pass
+            else:
+                instrument.disable()
+                raise ValueError("Instrumentation should not reopen the pool under a session.")
+            if t.countPlayers() != 4:
+                raise ValueError("The session should keep its connection.")
+        if stats.functions['iterStandings']['rows'] != 4:
+            raise ValueError("The rows of a generator should be counted.")
+        if stats.total['queries'] < stats.functions['registerPlayers']['queries'] + 8:
+            raise ValueError("The total should include the queries of every call.")
+    print "24. Instrumentation records calls, queries and rows per round."
+
 
 if __name__ == '__main__':
-    testCount()
-    testStandingsBeforeMatches()
-    testReportMatches()
-    testPairings()
+    # run the tests on the backends given on the command line, by default on
+    # PostgreSQL and in memory.
+    backends = sys.argv[1:] or ['postgres', 'memory']
+    for backend in backends:
+        print "Testing the %s backend" % backend
+        setBackend(backend)
+        testCount()
+        testStandingsBeforeMatches()
+        testReportMatches()
+        testPairings()
+        testBulkReport()
+        testPairingSnapshot()
+        testOpponentLookups()
+        testTiebreaks()
+        testStreaming()
+        testInstrumentation()
+        if backend == 'postgres':
+            # these use the database directly
+            testSession()
+            testStandingsTable()
+            testTournaments()
+            testMemoryFlush()
+            testNoSeqScans()
+            testPairingCache()
+    testPairingEngine()
+    testBacktrackPairings()
+    testSimulate()
     print "Success!  All tests pass!"